@@ -0,0 +1,303 @@
+# benchmark.py
+# Microbenchmarks for the redaction, NER and extraction hot paths, run on
+# synthetic documents, generated PDFs and redaction databases seeded with
+# vocabularies of growing size. Runs offline; NER is skipped when spaCy or
+# its models are missing.
+#
+#   python benchmark.py                      # measure and print
+#   python benchmark.py --save-baseline      # measure and store as the baseline
+#   python benchmark.py --threshold 0.2      # fail if >20% slower than the baseline
+#
+# Baselines are machine-specific; compare runs from the same machine.
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import fitz # PyMuPDF
+import redactor
+from extraction import extract_pdf_text
+
+DEFAULT_DOC_SIZES = '10000,100000,1000000'
+DEFAULT_VOCAB_SIZES = '1000,10000,100000'
+DEFAULT_PDF_PAGES = '10,100'
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+# Mappings in the namespace benchmarked alongside each shared vocabulary
+NAMESPACE_VOCAB_SIZE = 1000
+BENCH_NAMESPACE = 'bench-matter'
+# Slowdowns smaller than this many milliseconds are treated as noise
+NOISE_FLOOR_MS = 1.0
+# Memory growth smaller than this many KiB is treated as noise
+NOISE_FLOOR_KB = 256
+
+_FIRST_NAMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Elena', 'Felipe', 'Gabriela', 'Hugo', 'Ines', 'Joao',
+                'Karen', 'Luis', 'Marta', 'Nuno', 'Olivia', 'Pedro', 'Quentin', 'Rita', 'Sofia', 'Tiago']
+_WORDS = ['the', 'agreement', 'between', 'parties', 'shall', 'payment', 'invoice', 'meeting', 'report',
+          'quarter', 'revenue', 'contract', 'signed', 'by', 'and', 'with', 'of', 'in', 'on', 'for',
+          'confidential', 'project', 'review', 'client', 'account', 'date', 'terms', 'notice']
+
+def make_vocabulary(size, seed=0):
+    """
+    Returns `size` distinct synthetic person names, e.g. "Ana Bx0012".
+    """
+    rng = random.Random(seed)
+    names = [f"{_FIRST_NAMES[i % len(_FIRST_NAMES)]} {chr(65 + (i // 20) % 26)}x{i:05d}" for i in range(size)]
+    rng.shuffle(names)
+    return names
+
+def make_document(size, entities, seed=0, entity_rate=0.02):
+    """
+    Returns roughly `size` characters of prose with names from `entities`
+    mixed in, in lines of about 80 characters.
+    """
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    line = 0
+    while length < size:
+        token = rng.choice(entities) if entities and rng.random() < entity_rate else rng.choice(_WORDS)
+        line += len(token) + 1
+        if line > 80:
+            token += '\n'
+            line = 0
+        else:
+            token += ' '
+        parts.append(token)
+        length += len(token)
+    return ''.join(parts)
+
+def make_pdf(pages, seed=0):
+    """
+    Returns the bytes of a PDF with `pages` pages of synthetic text.
+    """
+    doc = fitz.open()
+    for page_number in range(pages):
+        page = doc.new_page()
+        text = make_document(2500, _FIRST_NAMES, seed=seed + page_number)
+        page.insert_textbox(fitz.Rect(50, 50, 560, 800), text, fontsize=8)
+    try:
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+def seed_database(path, vocabulary, namespaces=None):
+    """
+    Points the redactor at a fresh database at `path` holding one mapping per
+    vocabulary entry in the shared namespace, plus those of `namespaces`
+    (name -> vocabulary).
+    """
+    redactor._DB_PATH = path
+    redaction_db = redactor.RedactionDatabase()
+    try:
+        redaction_db.add_redactions({original: f"<ANON_{index:08x}>" for index, original in enumerate(vocabulary)})
+        offset = len(vocabulary)
+        for namespace, entries in (namespaces or {}).items():
+            redaction_db.add_redactions({original: f"<ANON_{offset + index:08x}>" for index, original in enumerate(entries)},
+                                        namespace=namespace)
+            offset += len(entries)
+    finally:
+        redaction_db.close()
+    redactor._vocabularies.invalidate()
+
+def measure(fn, repeat, warmup=1, memory=True):
+    """
+    Times fn() `repeat` times after `warmup` untimed calls, then measures
+    the peak Python allocation of one more call.
+    """
+    for _ in range(warmup):
+        fn()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    result = {
+        'median_ms': round(statistics.median(timings) * 1000, 3),
+        'min_ms': round(min(timings) * 1000, 3),
+    }
+    if memory:
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        result['peak_kb'] = round(peak / 1024, 1)
+    return result
+
+def _label(count):
+    return f"{count // 1000000}M" if count >= 1000000 and count % 1000000 == 0 else \
+        f"{count // 1000}k" if count >= 1000 and count % 1000 == 0 else str(count)
+
+def load_ner(language):
+    """
+    Returns utils._extract_entities if spaCy and the model for `language`
+    are available, otherwise None.
+    """
+    try:
+        import utils
+        if utils.nlp_models.get(language) is None:
+            return None
+        return utils._extract_entities
+    except Exception as e:
+        print(f"[BENCH] NER skipped: {e}")
+        return None
+
+def run_benchmarks(args, report):
+    doc_sizes = [int(size) for size in args.doc_sizes.split(',') if size]
+    vocab_sizes = [int(size) for size in args.vocab_sizes.split(',') if size]
+    pdf_pages = [int(pages) for pages in args.pdf_pages.split(',') if pages]
+    repeat = args.repeat
+    results = {}
+
+    def record(name, fn, repeat=repeat, warmup=1):
+        results[name] = measure(fn, repeat, warmup)
+        report(name, results[name])
+
+    for size in doc_sizes:
+        raw = '<p>' + make_document(size, _FIRST_NAMES, seed=size).replace('\n', '\n\n') + '</p>'
+        record(f"clean_text[doc={_label(size)}]", lambda: redactor.clean_text(raw))
+
+    workdir = tempfile.mkdtemp(prefix='redactor-bench-')
+    original_db_path = redactor._DB_PATH
+    try:
+        for vocab_size in vocab_sizes:
+            vocabulary = make_vocabulary(vocab_size)
+            # A matter of its own, distinct from the shared names
+            matter = [f"Matter {name}" for name in make_vocabulary(NAMESPACE_VOCAB_SIZE, seed=1)]
+            seed_database(os.path.join(workdir, f"redactions-{vocab_size}.db"), vocabulary, {BENCH_NAMESPACE: matter})
+            sample = vocabulary[:500]
+            probe = make_document(10000, sample, seed=1)
+
+            def cold_apply():
+                # Reload the vocabulary and rebuild the matcher, as after a DB write by another process
+                redactor._vocabularies.invalidate()
+                redactor.apply_stored_redactions(probe)
+            record(f"apply_stored_redactions[cold,vocab={_label(vocab_size)}]", cold_apply,
+                   repeat=max(1, min(repeat, 3)), warmup=0)
+
+            matter_probe = make_document(10000, matter[:500], seed=1)
+
+            def cold_apply_namespace():
+                # Should track the namespace's size, not the shared vocabulary's
+                redactor._vocabularies.invalidate(BENCH_NAMESPACE)
+                redactor.apply_stored_redactions(matter_probe, BENCH_NAMESPACE)
+            record(f"apply_stored_redactions[cold,namespace={_label(NAMESPACE_VOCAB_SIZE)},vocab={_label(vocab_size)}]",
+                   cold_apply_namespace, repeat=max(1, min(repeat, 3)), warmup=0)
+
+            for size in doc_sizes:
+                document = make_document(size, sample, seed=size)
+                label = f"doc={_label(size)},vocab={_label(vocab_size)}"
+                record(f"apply_stored_redactions[{label}]", lambda: redactor.apply_stored_redactions(document))
+
+                redacted = redactor.apply_stored_redactions(document)
+                record(f"deanonymize_using_db[{label}]", lambda: redactor.deanonymize_using_db(redacted))
+
+                # Entities already in the vocabulary, so the DB does not grow between runs
+                entities = {'PERSON': sample[:50], 'MANUAL': sample[50:60]}
+                record(f"redact_text[{label}]", lambda: redactor.redact_text(document, entities))
+    finally:
+        redactor._DB_PATH = original_db_path
+        redactor._vocabularies.invalidate()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    for pages in pdf_pages:
+        pdf = make_pdf(pages)
+        record(f"extract_pdf_text[pages={pages},workers=1]", lambda: extract_pdf_text(pdf, workers=1))
+        record(f"extract_pdf_text[pages={pages},parallel]", lambda: extract_pdf_text(pdf, min_pages=1))
+
+    if not args.skip_ner:
+        extract_entities = load_ner(args.language)
+        if extract_entities is None:
+            print(f"[BENCH] NER skipped: no spaCy model for '{args.language}'")
+        else:
+            for size in doc_sizes:
+                document = make_document(size, _FIRST_NAMES, seed=size)
+                # Calls the extractor directly; find_entities would answer from its cache
+                record(f"find_entities[doc={_label(size)}]", lambda: extract_entities(document, args.language),
+                       repeat=max(1, min(repeat, 3)))
+    return results
+
+def compare(results, baseline, threshold):
+    """
+    Returns a description of every result slower, or larger in peak memory,
+    than its baseline by more than `threshold` (a fraction).
+    """
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+        if (result['median_ms'] > previous['median_ms'] * (1 + threshold)
+                and result['median_ms'] - previous['median_ms'] > NOISE_FLOOR_MS):
+            regressions.append(f"{name}: {previous['median_ms']:.2f} ms -> {result['median_ms']:.2f} ms")
+        if ('peak_kb' in result and 'peak_kb' in previous
+                and result['peak_kb'] > previous['peak_kb'] * (1 + threshold)
+                and result['peak_kb'] - previous['peak_kb'] > NOISE_FLOOR_KB):
+            regressions.append(f"{name}: peak {previous['peak_kb']:.0f} KiB -> {result['peak_kb']:.0f} KiB")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the redaction, NER and extraction hot paths.")
+    parser.add_argument('--doc-sizes', default=DEFAULT_DOC_SIZES, help="Comma-separated document sizes in characters")
+    parser.add_argument('--vocab-sizes', default=DEFAULT_VOCAB_SIZES, help="Comma-separated numbers of stored mappings")
+    parser.add_argument('--pdf-pages', default=DEFAULT_PDF_PAGES, help="Comma-separated page counts of generated PDFs")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per benchmark (default: 5)")
+    parser.add_argument('--quick', action='store_true', help="Small sizes only, for a fast smoke run")
+    parser.add_argument('--language', default='en', help="Language of the spaCy model used for NER")
+    parser.add_argument('--skip-ner', action='store_true', help="Do not benchmark NER")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Baseline file to compare with or save to")
+    parser.add_argument('--save-baseline', action='store_true', help="Store these results as the new baseline")
+    parser.add_argument('--threshold', type=float, default=0.2, help="Allowed slowdown as a fraction (default: 0.2)")
+    parser.add_argument('--output', default='', help="Also write the results to this JSON file")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.doc_sizes, args.vocab_sizes, args.pdf_pages, args.repeat = '10000', '1000', '10', min(args.repeat, 3)
+
+    def report(name, result):
+        memory = f"{result['peak_kb']:>10.0f} KiB" if 'peak_kb' in result else ''
+        print(f"{name:<60} {result['median_ms']:>10.2f} ms {result['min_ms']:>10.2f} ms {memory}")
+
+    print(f"{'benchmark':<60} {'median':>13} {'min':>13} {'peak':>14}")
+    results = run_benchmarks(args, report)
+    payload = {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(payload, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(payload, f, indent=2)
+        print(f"[BENCH] Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"[BENCH] No baseline at {args.baseline}; run with --save-baseline to create one")
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print(f"[BENCH] {len(regressions)} regression(s) over {args.threshold:.0%}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print(f"[BENCH] No regressions over {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
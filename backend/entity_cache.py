@@ -0,0 +1,144 @@
+# entity_cache.py
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import weakref
+from collections import OrderedDict
+
+# Maximum number of results kept in memory
+ENTITY_CACHE_SIZE = int(os.environ.get('ENTITY_CACHE_SIZE', '256'))
+# Optional SQLite file that keeps results across restarts; empty disables it
+ENTITY_CACHE_DB = os.environ.get('ENTITY_CACHE_DB', '')
+
+def make_cache_key(text, language, version):
+    """
+    Builds a content address for a find_entities result.
+
+    Args:
+        text (str): The input text.
+        language (str): Language code.
+        version (str): Identifies the model, pattern files and extraction logic.
+
+    Returns:
+        str: Hex SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{version}\0{language}\0".encode('utf-8'))
+    digest.update(text.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+# Live caches, and connections inherited over a fork (see _reset_after_fork)
+_caches = weakref.WeakSet()
+_inherited_connections = []
+
+def _reset_after_fork():
+    """
+    Runs in a forked child (e.g. a CPU or batch worker process). SQLite
+    connections must not be used across a fork, and a lock another parent
+    thread held at fork time would never be released, so each cache
+    replaces both.
+    """
+    for cache in list(_caches):
+        cache._reset_after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+class EntityCache:
+    """
+    Size-bounded LRU of entity extraction results, with an optional
+    on-disk SQLite tier that survives restarts.
+    """
+    def __init__(self, max_entries=ENTITY_CACHE_SIZE, db_path=ENTITY_CACHE_DB):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        _caches.add(self)
+
+    def _reset_after_fork(self):
+        # The child opens its own connection; the inherited one stays
+        # referenced so the child never closes the parent's
+        if self._conn is not None:
+            _inherited_connections.append(self._conn)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _disk(self):
+        if not self.db_path:
+            return None
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS entity_cache
+                (key TEXT PRIMARY KEY, entities TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP)
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def _remember(self, key, entities):
+        self._entries[key] = entities
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        """
+        Returns a copy of the cached entities for a key, or None.
+        """
+        with self._lock:
+            entities = self._entries.get(key)
+            if entities is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return {label: set(values) for label, values in entities.items()}
+            conn = self._disk()
+            if conn is not None:
+                row = conn.execute('SELECT entities FROM entity_cache WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entities = {label: frozenset(values) for label, values in json.loads(row[0]).items()}
+                    self._remember(key, entities)
+                    self.disk_hits += 1
+                    return {label: set(values) for label, values in entities.items()}
+            self.misses += 1
+            return None
+
+    def put(self, key, entities):
+        """
+        Stores a find_entities result (a dict of label -> set of strings).
+        """
+        frozen = {label: frozenset(values) for label, values in entities.items()}
+        with self._lock:
+            self._remember(key, frozen)
+            conn = self._disk()
+            if conn is not None:
+                payload = json.dumps({label: sorted(values) for label, values in frozen.items()})
+                conn.execute('INSERT OR REPLACE INTO entity_cache (key, entities) VALUES (?, ?)', (key, payload))
+                conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            conn = self._disk()
+            if conn is not None:
+                conn.execute('DELETE FROM entity_cache')
+                conn.commit()
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'disk_tier': bool(self.db_path),
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_ratio': round((self.hits + self.disk_hits) / lookups, 3) if lookups else None,
+        }
@@ -0,0 +1,201 @@
+# executor.py
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# Jobs that may run at once; CPU-heavy request work beyond this waits in the queue
+CPU_WORKERS = int(os.environ.get('CPU_WORKERS', str(os.cpu_count() or 1)))
+# Jobs that may wait for a worker before new requests are turned away
+CPU_QUEUE_SIZE = int(os.environ.get('CPU_QUEUE_SIZE', '16'))
+# "thread" or "process"; processes sidestep the GIL but pickle their inputs
+CPU_EXECUTOR_KIND = os.environ.get('CPU_EXECUTOR_KIND', 'thread')
+# Seconds suggested to clients in the Retry-After header when busy
+CPU_RETRY_AFTER = int(os.environ.get('CPU_RETRY_AFTER', '5'))
+
+class ExecutorBusy(Exception):
+    """
+    Raised when the executor's workers and queue are all taken.
+    """
+    def __init__(self, retry_after):
+        super().__init__("Server is busy, please retry shortly.")
+        self.retry_after = retry_after
+
+_DONE = object()
+
+class BoundedExecutor:
+    """
+    Runs blocking, CPU-heavy work off the event loop.
+
+    At most `max_workers` jobs run at once and `max_queue` more may wait;
+    anything beyond that is rejected immediately with ExecutorBusy so the
+    caller can answer 503 instead of piling up work.
+
+    Every job is handed to a thread of this process that first takes one of
+    `max_workers` run slots, shared by run(), run_local() and stream(), so
+    the cap holds across all three; with kind "process" that thread then
+    passes the job to the process pool and waits for it.
+    """
+    def __init__(self, max_workers=CPU_WORKERS, max_queue=CPU_QUEUE_SIZE,
+                 kind=CPU_EXECUTOR_KIND, retry_after=CPU_RETRY_AFTER):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.kind = kind
+        self.retry_after = retry_after
+        self._process_pool = None
+        self._thread_pool = None
+        self._slots = threading.Semaphore(max_workers)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+
+    def _get_process_pool(self):
+        with self._lock:
+            if self._process_pool is None:
+                self._process_pool = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._process_pool
+
+    def _get_thread_pool(self):
+        # One thread per admitted job, so queued jobs wait on the run slots
+        # rather than behind each other in a pool's queue
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = ThreadPoolExecutor(max_workers=self.max_workers + self.max_queue,
+                                                       thread_name_prefix='cpu')
+            return self._thread_pool
+
+    def _take_slot(self):
+        self._slots.acquire()
+        with self._lock:
+            self._running += 1
+
+    def _give_slot(self):
+        with self._lock:
+            self._running -= 1
+        self._slots.release()
+
+    def _call(self, fn, local):
+        # Runs in a pool thread once the job is admitted
+        self._take_slot()
+        try:
+            if local or self.kind != 'process':
+                return fn()
+            return self._get_process_pool().submit(fn).result()
+        finally:
+            self._give_slot()
+
+    def _acquire(self):
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                raise ExecutorBusy(self.retry_after)
+            self._pending += 1
+
+    def _release(self, _future=None):
+        with self._lock:
+            self._pending -= 1
+
+    async def _submit(self, fn, args, kwargs, local):
+        self._acquire()
+        try:
+            future = self._get_thread_pool().submit(self._call, functools.partial(fn, *args, **kwargs), local)
+        except Exception:
+            self._release()
+            raise
+        # The slot is freed when the job really finishes, even if the
+        # awaiting request goes away first
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    async def run(self, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) in the pool and returns its result.
+        Raises ExecutorBusy without queuing if the executor is full.
+        """
+        return await self._submit(fn, args, kwargs, local=False)
+
+    async def run_local(self, fn, *args, **kwargs):
+        """
+        Like run(), but always in a thread of this process, for work that
+        reads or changes in-memory state (retrieval indexes, redaction
+        sessions) a worker process would not share.
+        """
+        return await self._submit(fn, args, kwargs, local=True)
+
+    def stream(self, fn, *args, max_pending=None, **kwargs):
+        """
+        Starts iterating the generator fn(*args, **kwargs) in a worker thread
+        and returns an async iterator over the items it yields.
+
+        The slot is reserved immediately, so ExecutorBusy is raised here
+        rather than on first iteration. Closing the async iterator stops the
+        worker after its current item. With `max_pending`, the worker waits
+        once that many items are unread, so a slow reader bounds memory; while
+        it waits its run slot is free for other jobs.
+        """
+        self._acquire()
+        loop = asyncio.get_running_loop()
+        items = asyncio.Queue()
+        stop = threading.Event()
+        slots = threading.Semaphore(max_pending) if max_pending else None
+
+        def post(item):
+            try:
+                loop.call_soon_threadsafe(items.put_nowait, item)
+            except RuntimeError:
+                # The event loop has closed; nobody is listening anymore
+                stop.set()
+
+        def produce():
+            self._take_slot()
+            try:
+                for item in fn(*args, **kwargs):
+                    if slots is not None and not slots.acquire(blocking=False):
+                        self._give_slot()
+                        try:
+                            while not slots.acquire(timeout=0.1) and not stop.is_set():
+                                pass
+                        finally:
+                            self._take_slot()
+                    if stop.is_set():
+                        break
+                    post((item, None))
+            except BaseException as e:
+                post((None, e))
+            finally:
+                self._give_slot()
+                post((_DONE, None))
+
+        try:
+            future = self._get_thread_pool().submit(produce)
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+
+        async def consume():
+            try:
+                while True:
+                    item, error = await items.get()
+                    if slots is not None:
+                        slots.release()
+                    if error is not None:
+                        raise error
+                    if item is _DONE:
+                        return
+                    yield item
+            finally:
+                stop.set()
+
+        return consume()
+
+    def stats(self):
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+            'pending': self._pending,
+            'running': self._running,
+        }
+
+cpu_executor = BoundedExecutor()
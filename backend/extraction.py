@@ -0,0 +1,149 @@
+# extraction.py
+import codecs
+import os
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import fitz # PyMuPDF
+
+from metrics import timed
+
+# PDFs with at least this many pages are extracted by a process pool
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', '200'))
+# Number of worker processes used for parallel extraction
+PDF_EXTRACTION_WORKERS = int(os.environ.get('PDF_EXTRACTION_WORKERS', str(os.cpu_count() or 1)))
+# Page ranges handed out per worker; more ranges balance uneven pages better
+PDF_RANGES_PER_WORKER = 4
+
+# Bytes read at a time when a .txt file is processed as a stream
+TEXT_READ_CHUNK_BYTES = int(os.environ.get('TEXT_READ_CHUNK_BYTES', str(1 << 20)))
+
+# File types that can be uploaded and redacted
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_extraction_pool():
+    """
+    Returns the shared process pool used for parallel PDF extraction,
+    starting it on first use.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=PDF_EXTRACTION_WORKERS)
+    return _pool
+
+def open_pdf(data):
+    """
+    Opens a PDF straight from its bytes, without writing it to disk.
+    """
+    return fitz.open(stream=data, filetype="pdf")
+
+def _extract_page_range(path, start, stop):
+    # Runs in a worker process: each task opens the spooled file and reads
+    # only its own pages, so the PDF bytes never go through the pool's pipes
+    doc = fitz.open(path)
+    try:
+        return [doc[index].get_text() for index in range(start, stop)]
+    finally:
+        doc.close()
+
+def _page_ranges(page_count, parts):
+    size = max(1, -(-page_count // parts))
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+def iter_pdf_pages(data, workers=None, min_pages=None):
+    """
+    Yields the text of each page of a PDF as it is extracted.
+
+    Documents with at least `min_pages` pages are split into page ranges
+    and extracted in parallel by the process pool; pages are still
+    yielded in order.
+
+    Args:
+        data (bytes): The PDF file contents.
+        workers (int): Page ranges extracted at once, so at most this many
+            pool processes work on the document (the pool itself has
+            PDF_EXTRACTION_WORKERS). Defaults to PDF_EXTRACTION_WORKERS.
+        min_pages (int): Page count that triggers parallel extraction.
+            Defaults to PDF_PARALLEL_MIN_PAGES.
+
+    Yields:
+        tuple: (page_number, page_count, text), with page_number starting at 1.
+    """
+    workers = PDF_EXTRACTION_WORKERS if workers is None else workers
+    min_pages = PDF_PARALLEL_MIN_PAGES if min_pages is None else min_pages
+
+    doc = open_pdf(data)
+    try:
+        page_count = doc.page_count
+        if workers <= 1 or page_count < min_pages:
+            for index, page in enumerate(doc):
+                yield index + 1, page_count, page.get_text()
+            return
+    finally:
+        doc.close()
+
+    # Written once for all workers instead of pickled into every task
+    fd, path = tempfile.mkstemp(suffix='.pdf')
+    futures = []
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        pool = get_extraction_pool()
+        ranges = iter(_page_ranges(page_count, workers * PDF_RANGES_PER_WORKER))
+        # Keep at most `workers` ranges in flight; each finished one makes room for the next
+        futures = deque((start, pool.submit(_extract_page_range, path, start, stop))
+                        for start, stop in islice(ranges, workers))
+        while futures:
+            start, future = futures.popleft()
+            texts = future.result()
+            for next_start, next_stop in islice(ranges, 1):
+                futures.append((next_start, pool.submit(_extract_page_range, path, next_start, next_stop)))
+            for offset, text in enumerate(texts):
+                yield start + offset + 1, page_count, text
+    finally:
+        for _, future in futures:
+            future.cancel()
+        try:
+            os.remove(path)
+        except OSError:
+            # A worker still reading a cancelled range may hold it open on Windows
+            pass
+
+@timed('pdf_extraction')
+def extract_pdf_text(data, workers=None, min_pages=None):
+    """
+    Returns the text of every page of a PDF, in page order.
+    """
+    return "".join(text for _, _, text in iter_pdf_pages(data, workers, min_pages))
+
+def iter_text_file(f, chunk_bytes=TEXT_READ_CHUNK_BYTES):
+    """
+    Yields the UTF-8 text of a binary file object piece by piece, so the
+    file is never held in memory whole.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        block = f.read(chunk_bytes)
+        if not block:
+            break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    text = decoder.decode(b'', final=True)
+    if text:
+        yield text
+
+def extract_text(filename, data):
+    """
+    Returns the raw text of an uploaded .pdf or .txt file.
+    """
+    if filename.lower().endswith('.pdf'):
+        return extract_pdf_text(data)
+    return data.decode('utf-8')
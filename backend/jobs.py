@@ -0,0 +1,326 @@
+# jobs.py
+# Batch anonymization: many documents go through extraction, NER and redaction
+# in one job. Extraction and NER run across a worker pool; redaction stays in
+# this process so every document draws its tags from the same redaction DB
+# mappings. Per-document results are appended to an NDJSON file that clients
+# can follow while the job runs.
+import asyncio
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import utils
+from extraction import extract_pdf_text
+from redactor import clean_text, apply_stored_redactions, redact_text, SHARED_NAMESPACE
+
+logger = logging.getLogger(__name__)
+
+# Documents analyzed at once
+BATCH_WORKERS = int(os.environ.get('BATCH_WORKERS', str(os.cpu_count() or 1)))
+# "process" or "thread"; processes run NER in parallel past the GIL
+BATCH_EXECUTOR_KIND = os.environ.get('BATCH_EXECUTOR_KIND', 'process')
+# Where job inputs and NDJSON results are kept
+BATCH_JOB_DIR = os.environ.get('BATCH_JOB_DIR', os.path.join(tempfile.gettempdir(), 'obfuscator-jobs'))
+# Seconds a finished job and its results are kept
+BATCH_JOB_TTL = float(os.environ.get('BATCH_JOB_TTL', '86400'))
+# Seconds between checks for new results while following a running job
+BATCH_POLL_INTERVAL = 0.25
+
+FINISHED_STATES = ('completed', 'cancelled', 'failed')
+
+def init_worker():
+    # Documents are already spread across workers; nested process pools for
+    # PDF pages or NER chunks would only oversubscribe the CPUs
+    utils.NER_PROCESSES = 1
+
+def analyze_document(path, name, is_text, language):
+    """
+    Runs in a worker: extracts and cleans one document and finds its entities.
+
+    Returns:
+        tuple: (cleaned text, entities by label)
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not is_text and name.lower().endswith('.pdf'):
+        text = extract_pdf_text(data, workers=1)
+    else:
+        text = data.decode('utf-8')
+    text = clean_text(text)
+    return text, utils.find_entities(text, language)
+
+def analyze_in_pool(pool, documents, language, max_in_flight, cancelled=None):
+    """
+    Runs analyze_document() over documents in a worker pool, keeping at most
+    `max_in_flight` of them submitted so large batches are not all queued
+    at once.
+
+    Args:
+        pool: A concurrent.futures executor.
+        documents (list): Dicts with 'path', 'name' and 'is_text'.
+        language (str): Language code for NER.
+        max_in_flight (int): Documents submitted at a time.
+        cancelled (threading.Event): Once set, no more documents are submitted.
+
+    Yields:
+        tuple: (index, document, future) in completion order.
+    """
+    queued = iter(enumerate(documents))
+    pending = {}
+
+    def submit_next():
+        if cancelled is not None and cancelled.is_set():
+            return
+        for index, document in queued:
+            future = pool.submit(analyze_document, document['path'], document['name'], document['is_text'], language)
+            pending[future] = (index, document)
+            return
+
+    for _ in range(max_in_flight):
+        submit_next()
+    try:
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, document = pending.pop(future)
+                yield index, document, future
+                submit_next()
+    finally:
+        for future in pending:
+            future.cancel()
+
+def redact_analyzed(text, entities, entity_types=None, namespace=SHARED_NAMESPACE, include_shared=False):
+    """
+    Redacts an analyzed document: stored redactions first, as /upload does,
+    then the entities found in it, optionally limited to some labels. Tags
+    are reused from and stored in `namespace`.
+
+    Returns:
+        tuple: (redacted text, redaction_map, selected entities by label)
+    """
+    selected = {label: values for label, values in entities.items()
+                if entity_types is None or label in entity_types}
+    redacted, redaction_map = redact_text(apply_stored_redactions(text, namespace, include_shared), selected,
+                                          namespace, include_shared)
+    return redacted, redaction_map, selected
+
+class BatchJob:
+    """
+    One batch of documents and its progress. Results are written to
+    `results_path`, one JSON object per line, in completion order.
+    """
+    def __init__(self, job_id, directory, language='en', entity_types=None,
+                 namespace=SHARED_NAMESPACE, include_shared=False):
+        self.job_id = job_id
+        self.directory = directory
+        self.results_path = os.path.join(directory, 'results.ndjson')
+        self.language = language
+        self.entity_types = set(entity_types) if entity_types else None
+        self.namespace = namespace
+        self.include_shared = include_shared
+        self.documents = []
+        self.status = 'queued'
+        self.error = None
+        self.completed = 0
+        self.failed = 0
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancelled = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in FINISHED_STATES
+
+    def add_document(self, name, source=None, text=None):
+        """
+        Spools one input to the job directory, from a binary file object
+        or from a string.
+        """
+        path = os.path.join(self.directory, 'inputs', str(len(self.documents)))
+        if text is not None:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        else:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(source, f)
+        self.documents.append({'name': name, 'path': path, 'is_text': text is not None})
+
+    def read_results(self, offset):
+        """
+        Returns (data, new_offset): the complete NDJSON lines written after `offset`.
+        """
+        try:
+            with open(self.results_path, 'rb') as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return b"", offset
+        end = data.rfind(b"\n") + 1
+        return data[:end], offset + end
+
+    async def follow_results(self, poll_interval=BATCH_POLL_INTERVAL):
+        """
+        Yields NDJSON result lines as they are written, until the job finishes.
+        """
+        offset = 0
+        while True:
+            # Check before reading so the last lines are not missed
+            finished = self.finished
+            data, offset = await asyncio.to_thread(self.read_results, offset)
+            if data:
+                yield data
+            elif finished:
+                return
+            else:
+                await asyncio.sleep(poll_interval)
+
+    def stats(self):
+        processed = self.completed + self.failed
+        end = self.finished_at or time.time()
+        elapsed = end - self.started_at if self.started_at else 0
+        return {
+            'job_id': self.job_id,
+            'namespace': self.namespace,
+            'status': self.status,
+            'error': self.error,
+            'total': len(self.documents),
+            'completed': self.completed,
+            'failed': self.failed,
+            'progress': round(processed / len(self.documents), 3) if self.documents else 1.0,
+            'elapsed': round(elapsed, 2),
+            'documents_per_second': round(processed / elapsed, 2) if elapsed else None,
+        }
+
+class BatchJobManager:
+    """
+    Creates batch jobs and runs each in its own thread, feeding documents
+    to a shared worker pool.
+    """
+    def __init__(self, max_workers=BATCH_WORKERS, kind=BATCH_EXECUTOR_KIND,
+                 job_dir=BATCH_JOB_DIR, ttl=BATCH_JOB_TTL):
+        self.max_workers = max_workers
+        self.kind = kind
+        self.job_dir = job_dir
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                if self.kind == 'process':
+                    self._pool = ProcessPoolExecutor(max_workers=self.max_workers, initializer=init_worker)
+                else:
+                    self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='batch')
+            return self._pool
+
+    def create(self, language='en', entity_types=None, namespace=SHARED_NAMESPACE, include_shared=False):
+        self.purge_expired()
+        job_id = uuid.uuid4().hex
+        job = BatchJob(job_id, os.path.join(self.job_dir, job_id), language, entity_types,
+                       namespace, include_shared)
+        os.makedirs(os.path.join(job.directory, 'inputs'))
+        with self._lock:
+            self._jobs[job_id] = job
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def list_jobs(self):
+        return [job.stats() for job in list(self._jobs.values())]
+
+    def start(self, job):
+        threading.Thread(target=self._run, args=(job,), name=f'batch-{job.job_id[:8]}', daemon=True).start()
+
+    def _redact(self, job, index, document, future):
+        try:
+            text, entities = future.result()
+            redacted, redaction_map, selected = redact_analyzed(text, entities, job.entity_types,
+                                                                job.namespace, job.include_shared)
+            job.completed += 1
+            return {
+                'index': index,
+                'name': document['name'],
+                'status': 'ok',
+                'text': redacted,
+                'redaction_map': redaction_map,
+                'entities': {label: len(values) for label, values in selected.items()},
+            }
+        except Exception as e:
+            job.failed += 1
+            return {'index': index, 'name': document['name'], 'status': 'error', 'error': str(e)}
+
+    def _run(self, job):
+        job.status = 'running'
+        job.started_at = time.time()
+        try:
+            analyzed = analyze_in_pool(self._get_pool(), job.documents, job.language,
+                                       self.max_workers * 2, job.cancelled)
+            with open(job.results_path, 'a', encoding='utf-8') as results:
+                for index, document, future in analyzed:
+                    results.write(json.dumps(self._redact(job, index, document, future)) + "\n")
+                    results.flush()
+                    os.remove(document['path'])
+            job.status = 'cancelled' if job.cancelled.is_set() else 'completed'
+        except Exception as e:
+            logger.error("[JOBS] Job %s failed: %s", job.job_id, e)
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job.finished_at = time.time()
+            if job.job_id not in self._jobs:
+                # Deleted while running
+                shutil.rmtree(job.directory, ignore_errors=True)
+
+    def cancel(self, job):
+        """
+        Stops handing out the job's remaining documents; those already
+        being analyzed still finish.
+        """
+        job.cancelled.set()
+        if job.status == 'queued':
+            job.status = 'cancelled'
+            job.finished_at = time.time()
+
+    def delete(self, job_id):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            self.cancel(job)
+            if job.finished:
+                shutil.rmtree(job.directory, ignore_errors=True)
+
+    def purge_expired(self):
+        """
+        Removes finished jobs, with their results, older than the TTL.
+        """
+        if self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            expired = [job for job in self._jobs.values() if job.finished and job.finished_at < cutoff]
+            for job in expired:
+                del self._jobs[job.job_id]
+        for job in expired:
+            shutil.rmtree(job.directory, ignore_errors=True)
+
+    def stats(self):
+        jobs = list(self._jobs.values())
+        return {
+            'kind': self.kind,
+            'max_workers': self.max_workers,
+            'jobs': len(jobs),
+            'running': sum(1 for job in jobs if job.status == 'running'),
+        }
+
+batch_jobs = BatchJobManager()
@@ -0,0 +1,160 @@
+# llm.py
+# Async streaming helpers for the LLM providers. Each yields text chunks as
+# they arrive without blocking the event loop; when the consumer stops
+# iterating (e.g. the client disconnected) the upstream request is closed
+# and we stop paying for tokens nobody reads.
+import logging
+import os
+import threading
+
+import httpx
+import openai
+import google.generativeai as genai
+
+from metrics import LLMTimer
+
+logger = logging.getLogger(__name__)
+
+# Connection pool limits for the shared OpenAI HTTP client
+LLM_MAX_CONNECTIONS = int(os.environ.get('LLM_MAX_CONNECTIONS', '100'))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', '20'))
+LLM_KEEPALIVE_EXPIRY = float(os.environ.get('LLM_KEEPALIVE_EXPIRY', '120'))
+
+try:
+    from contextlib import aclosing
+except ImportError: # Python < 3.10
+    class aclosing:
+        def __init__(self, thing):
+            self.thing = thing
+
+        async def __aenter__(self):
+            return self.thing
+
+        async def __aexit__(self, *exc_info):
+            await self.thing.aclose()
+
+class ProviderClients:
+    """
+    Long-lived LLM clients, one per provider and API key.
+
+    Reusing clients keeps HTTP connections (and their TLS sessions) alive
+    between requests. Clients are only rebuilt after `retain()` drops them,
+    which the API key endpoints call when a key changes.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._openai = {}
+        self._gemini_key = None
+        self._gemini_models = {}
+
+    def openai(self, api_key):
+        """
+        Returns the shared openai.AsyncOpenAI client for an API key.
+        """
+        client = self._openai.get(api_key)
+        if client is None:
+            with self._lock:
+                client = self._openai.get(api_key)
+                if client is None:
+                    http_client = httpx.AsyncClient(
+                        limits=httpx.Limits(
+                            max_connections=LLM_MAX_CONNECTIONS,
+                            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+                        ),
+                        timeout=httpx.Timeout(600.0, connect=10.0),
+                    )
+                    client = openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
+                    self._openai[api_key] = client
+        return client
+
+    def gemini(self, api_key, model_id):
+        """
+        Returns a cached genai.GenerativeModel, configuring the Gemini SDK
+        only when the API key differs from the one it was configured with.
+        """
+        with self._lock:
+            if api_key != self._gemini_key:
+                genai.configure(api_key=api_key)
+                self._gemini_key = api_key
+                self._gemini_models = {}
+            model = self._gemini_models.get(model_id)
+            if model is None:
+                model = genai.GenerativeModel(model_id)
+                self._gemini_models[model_id] = model
+            return model
+
+    async def retain(self, openai_key=None, gemini_key=None):
+        """
+        Drops clients built for any key other than the given current ones,
+        closing their connection pools. Called when API keys change.
+        """
+        with self._lock:
+            stale = [client for key, client in self._openai.items() if key != openai_key]
+            self._openai = {key: client for key, client in self._openai.items() if key == openai_key}
+            if self._gemini_key != gemini_key:
+                self._gemini_key = None
+                self._gemini_models = {}
+        for client in stale:
+            await client.close()
+
+llm_clients = ProviderClients()
+
+async def stream_openai_chat(client, model_id, messages, max_tokens, temperature=0.2):
+    """
+    Streams a chat completion from an openai.AsyncOpenAI client.
+
+    Yields:
+        str: Content deltas in order.
+    """
+    timer = LLMTimer('openai', model_id, 'stream')
+    try:
+        stream = await client.chat.completions.create(
+            model=model_id,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            stream=True
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    timer.first_chunk()
+                    yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+    except BaseException as e:
+        timer.finish(type(e))
+        raise
+    timer.finish()
+
+async def stream_gemini(gemini_model, prompt, log_prefix="GEMINI"):
+    """
+    Streams a response from a genai.GenerativeModel using its async API.
+    Chunks blocked by the safety filter are skipped.
+
+    Yields:
+        str: Text chunks in order.
+    """
+    timer = LLMTimer('gemini', getattr(gemini_model, 'model_name', 'gemini').removeprefix('models/'), 'stream')
+    try:
+        response = await gemini_model.generate_content_async(prompt, stream=True)
+        chunk_count = 0
+        async for chunk in response:
+            chunk_count += 1
+            try:
+                text = chunk.text
+            except ValueError as e:
+                # Handle safety filter blocks and other chunk access errors
+                if "finish_reason" in str(e):
+                    logger.warning("[%s] Chunk #%d blocked by safety filter: %s", log_prefix, chunk_count, e)
+                    continue
+                logger.error("[%s] Error accessing chunk #%d: %s", log_prefix, chunk_count, e)
+                raise
+            if text:
+                timer.first_chunk()
+                yield text
+    except BaseException as e:
+        timer.finish(type(e))
+        raise
+    timer.finish()
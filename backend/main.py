@@ -1,22 +1,44 @@
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, BackgroundTasks, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import uvicorn
 import os
-import shutil
 import json
-import asyncio
+import logging
 import sys
+import time
 from typing import List, Dict, Any, Optional
-import fitz # PyMuPDF
 import pickle
+import functools
 from pathlib import Path
 
 # Actual imports for your redaction and entity logic
-from redactor import redact_text, unredact_text, clean_text, apply_stored_redactions, deanonymize_using_db
-from utils import find_entities
+from redactor import redact_text, unredact_text, clean_text, apply_stored_redactions, deanonymize_using_db, process_text, iter_process_text, normalize_namespace
+from utils import find_entities, nlp_models, entity_cache
+from extraction import iter_pdf_pages, extract_text, iter_text_file, SUPPORTED_EXTENSIONS
+from executor import cpu_executor, ExecutorBusy
+from llm import stream_openai_chat, stream_gemini, aclosing, llm_clients
+from summary_cache import SummaryCache, make_summary_key, replay_chunks
+from retrieval import retrieval_indexes, document_id, RETRIEVAL_MIN_CHARS
+from sessions import session_store, compact_session
+from redaction_sessions import redaction_sessions
+from jobs import batch_jobs
+from map_reduce import needs_map_reduce, split_into_sections, iter_section_summaries, collapse_summaries, join_section_summaries
+import metrics
+from metrics import time_llm
+import profiling
+from profiling import run_profiled, profile_store
+
+# DEBUG also logs each /redact request's selections and a text excerpt
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+if LOG_LEVEL != 'DEBUG':
+    # httpx logs every LLM provider request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -30,9 +52,25 @@ app.add_middleware(
 )
 
 class RedactRequest(BaseModel):
-    text: str
-    entities: dict
+    text: str = ""  # Not needed with session_id
+    entities: dict = {}
     custom_entities: list = []  # For manual selection redaction
+    session_id: Optional[str] = None  # From /redact-sessions; the response then carries edits, not the text
+    version: Optional[int] = None  # Session version the client's text is at, if it wants that checked
+    namespace: Optional[str] = None  # Project, matter or tenant ID; the shared vocabulary if omitted
+    include_shared: bool = False  # Also reuse tags from the shared vocabulary
+
+class RedactSessionRequest(BaseModel):
+    text: str
+    namespace: Optional[str] = None
+    include_shared: bool = False
+
+class BatchTextsRequest(BaseModel):
+    documents: List[Dict[str, str]]  # List of {"name": ..., "text": ...}
+    language: str = "en"
+    entity_types: Optional[List[str]] = None  # e.g. ["PERSON", "ORG"]; all detected types if omitted
+    namespace: Optional[str] = None
+    include_shared: bool = False
 
 class SummarizeRequest(BaseModel):
     text: str
@@ -40,91 +78,457 @@ class SummarizeRequest(BaseModel):
 
 class DeanonymizeRequest(BaseModel):
     text: str
+    namespace: Optional[str] = None  # Only tags stored in this namespace are resolved
+    include_shared: bool = False
 
 # New model for follow-up requests
 class FollowUpRequest(BaseModel):
-    history: List[Dict[str, str]]  # List of {"role": "user"/"assistant", "content": ...}
+    history: List[Dict[str, str]] = []  # List of {"role": "user"/"assistant", "content": ...}
     question: str
     model: str = "gpt-4o" # Default model if not specified
+    document_id: Optional[str] = None # From /upload or /process-text; the history then omits the document
+    session_id: Optional[str] = None # From /sessions; the server keeps the history and `history` is ignored
+
+class SessionRequest(BaseModel):
+    document_id: Optional[str] = None # From /upload or /process-text
+    text: Optional[str] = None # Or the document itself
 
 class ProcessTextRequest(BaseModel):
     text: str
+    namespace: Optional[str] = None  # Apply only this namespace's stored redactions
+    include_shared: bool = False  # ...plus the shared vocabulary's
 
-@app.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    # Save uploaded file temporarily
-    temp_path = f"temp_{file.filename}"
-    with open(temp_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-    
-    extracted_text = ""
+def is_supported_upload(filename):
+    return filename.lower().endswith(SUPPORTED_EXTENSIONS)
+
+UNSUPPORTED_UPLOAD_ERROR = "Unsupported file type. Please upload a .txt or .pdf file."
+
+def busy_response(e):
+    """503 telling the client when to retry, used when the CPU executor is full"""
+    return JSONResponse(status_code=503, content={"error": str(e)}, headers={"Retry-After": str(e.retry_after)})
+
+PROFILE_FORBIDDEN_ERROR = "Profiling is disabled or the X-Profile-Token is wrong."
+
+def profile_denied(profile_token):
+    """403 for a request asking to be profiled without the admin token; None otherwise"""
+    if profile_token is not None and not profiling.authorized(profile_token):
+        return JSONResponse(status_code=403, content={"error": PROFILE_FORBIDDEN_ERROR})
+    return None
+
+def namespace_invalid(namespace):
+    """400 for a namespace normalize_namespace() rejects; None otherwise"""
     try:
-        if file.filename.lower().endswith('.pdf'):
-            doc = fitz.open(temp_path)
-            for page in doc:
-                extracted_text += page.get_text()
-            doc.close()
-            extracted_text = clean_text(extracted_text) # Apply cleaning to PDF text
-        elif file.filename.lower().endswith('.txt'):
-            with open(temp_path, 'r', encoding='utf-8') as f:
-                extracted_text = clean_text(f.read())
-        else:
-            return JSONResponse(status_code=400, content={"error": "Unsupported file type. Please upload a .txt or .pdf file."})
+        normalize_namespace(namespace)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    return None
+
+async def run_cpu_job(response, profile_token, endpoint, fn, *args, local=False, **kwargs):
+    """
+    Runs fn in the CPU executor, in a thread of this process if `local` is
+    set (for fn that changes in-memory state). When the request carries a
+    profile token (already checked by profile_denied), the run is sampled and
+    the stored profile's id is sent back in the X-Profile-Id header.
+    """
+    run = cpu_executor.run_local if local else cpu_executor.run
+    if profile_token is None:
+        return await run(fn, *args, **kwargs)
+    result, folded, seconds = await run(run_profiled, fn, *args, **kwargs)
+    response.headers["X-Profile-Id"] = await run_in_threadpool(profile_store.save, endpoint, folded, seconds)
+    return result
+
+async def read_upload(file):
+    """Reads an upload into memory, timed as the upload_read stage"""
+    start = time.perf_counter()
+    data = await file.read()
+    if metrics.METRICS_ENABLED:
+        metrics.observe_stage('upload_read', time.perf_counter() - start, len(data))
+    return data
+
+def index_document(text):
+    # Index text for follow-up questions. Must run in this process (see
+    # cpu_executor.run_local): /followup and /sessions look indexes up here
+    doc_id, _ = retrieval_indexes.get_or_build(text)
+    return doc_id
+
+def reindex_redacted(original_text, redacted_text):
+    """
+    Indexes redacted text for follow-up questions and drops the index of the
+    text it replaces, so the old document_id can no longer send the names
+    just redacted to a model.
+    """
+    if redacted_text != original_text:
+        retrieval_indexes.discard(document_id(original_text))
+    return index_document(redacted_text)
+
+def prepare_text(text, namespace='', include_shared=False):
+    # Clean and apply stored redactions
+    return process_text(text, namespace, include_shared)
 
-        # Apply stored redactions BEFORE sending back to frontend
-        processed_text = apply_stored_redactions(extracted_text)
+def prepare_text_file(f, namespace='', include_shared=False):
+    # Decode, clean and redact a .txt upload window by window; only the
+    # result is ever held whole, not the raw bytes and each pass's copy
+    return "".join(iter_process_text(iter_text_file(f), namespace, include_shared))
 
+def prepare_upload(filename, data, namespace='', include_shared=False):
+    # Extract, clean and apply stored redactions BEFORE sending back to frontend
+    return prepare_text(extract_text(filename, data), namespace, include_shared)
+
+def upload_events(filename, data, namespace='', include_shared=False):
+    """Yields progress events for /upload-stream, ending with the processed text"""
+    if filename.lower().endswith('.pdf'):
+        pages = []
+        for page_number, page_count, page_text in iter_pdf_pages(data):
+            pages.append(page_text)
+            # Partial text is cleaned and redacted per page; the final
+            # event carries the authoritative full-document result
+            partial = process_text(page_text, namespace, include_shared)
+            yield {'status': 'extracting', 'page': page_number, 'pages': page_count, 'chunk': partial}
+        extracted_text = "".join(pages)
+    else:
+        extracted_text = data.decode('utf-8')
+
+    yield {'status': 'redacting', 'message': 'Applying stored redactions...'}
+    processed_text = prepare_text(extracted_text, namespace, include_shared)
+    # Streaming jobs always run in a thread of this process
+    doc_id = index_document(processed_text)
+    yield {'done': True, 'filename': filename, 'text': processed_text, 'document_id': doc_id}
+
+@app.post("/upload")
+async def upload_file(response: Response, file: UploadFile = File(...), namespace: str = Form(""),
+                      include_shared: bool = Form(False), x_profile_token: Optional[str] = Header(None)):
+    if not is_supported_upload(file.filename):
+        return JSONResponse(status_code=400, content={"error": UNSUPPORTED_UPLOAD_ERROR})
+    denied = profile_denied(x_profile_token) or namespace_invalid(namespace)
+    if denied:
+        return denied
+    namespace = normalize_namespace(namespace)
+    try:
+        if file.filename.lower().endswith('.txt') and cpu_executor.kind == 'thread':
+            # Read the spooled upload in windows rather than all at once
+            await file.seek(0)
+            processed_text = await run_cpu_job(response, x_profile_token, "/upload", prepare_text_file, file.file,
+                                               namespace, include_shared)
+        else:
+            # Work on the upload in memory; no temp file round trip
+            data = await read_upload(file)
+            processed_text = await run_cpu_job(response, x_profile_token, "/upload", prepare_upload, file.filename, data,
+                                               namespace, include_shared)
+        doc_id = await cpu_executor.run_local(index_document, processed_text)
+    except ExecutorBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
-    finally:
-        # Ensure temp file is removed even if apply_stored_redactions fails
-        if os.path.exists(temp_path):
-             os.remove(temp_path)
-    return {"filename": file.filename, "text": processed_text}
+    return {"filename": file.filename, "text": processed_text, "document_id": doc_id}
+
+# Streaming variant of /upload that reports per-page progress for PDFs
+@app.post("/upload-stream")
+async def upload_file_stream(file: UploadFile = File(...), namespace: str = Form(""), include_shared: bool = Form(False)):
+    if not is_supported_upload(file.filename):
+        return JSONResponse(status_code=400, content={"error": UNSUPPORTED_UPLOAD_ERROR})
+    invalid = namespace_invalid(namespace)
+    if invalid:
+        return invalid
+    data = await read_upload(file)
+    try:
+        events = cpu_executor.stream(upload_events, file.filename, data, normalize_namespace(namespace), include_shared)
+    except ExecutorBusy as e:
+        return busy_response(e)
+
+    async def generate():
+        try:
+            async for event in events:
+                yield f"data: {json.dumps(event)}\n\n"
+        except Exception as e:
+            yield f"data: {json.dumps({'error': str(e)})}\n\n"
+        finally:
+            await events.aclose()
+
+    response = StreamingResponse(generate(), media_type="text/event-stream")
+    # Add headers to prevent buffering and ensure immediate streaming
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["Connection"] = "keep-alive"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# Windows of processed text buffered for a slow /process-file reader
+PROCESS_FILE_MAX_PENDING = 4
+
+@app.post("/process-file")
+async def process_file(file: UploadFile = File(...), namespace: str = Form(""), include_shared: bool = Form(False)):
+    """
+    Cleans a .txt upload and applies stored redactions, streaming the result
+    back as plain text. Memory use does not grow with the file size; the
+    result is not indexed for follow-up questions.
+    """
+    if not file.filename.lower().endswith('.txt'):
+        return JSONResponse(status_code=400, content={"error": "Only .txt files can be processed as a stream."})
+    invalid = namespace_invalid(namespace)
+    if invalid:
+        return invalid
+    await file.seek(0)
+    try:
+        pieces = cpu_executor.stream(iter_process_text, iter_text_file(file.file), normalize_namespace(namespace),
+                                     include_shared, max_pending=PROCESS_FILE_MAX_PENDING)
+    except ExecutorBusy as e:
+        return busy_response(e)
+
+    async def generate():
+        try:
+            async for piece in pieces:
+                yield piece
+        except Exception as e:
+            # The status line is already sent; the body ends early
+            logger.error("/process-file failed for %s: %s", file.filename, e)
+        finally:
+            await pieces.aclose()
+
+    return StreamingResponse(generate(), media_type="text/plain; charset=utf-8")
 
 @app.post("/process-text")
-async def process_text_input(data: ProcessTextRequest):
+async def process_text_input(data: ProcessTextRequest, response: Response, x_profile_token: Optional[str] = Header(None)):
+    denied = profile_denied(x_profile_token) or namespace_invalid(data.namespace)
+    if denied:
+        return denied
     try:
         # Basic cleaning and then apply stored redactions
-        cleaned = clean_text(data.text)
-        processed_text = apply_stored_redactions(cleaned)
-        return {"text": processed_text}
+        processed_text = await run_cpu_job(response, x_profile_token, "/process-text", prepare_text, data.text,
+                                           normalize_namespace(data.namespace), data.include_shared)
+        doc_id = await cpu_executor.run_local(index_document, processed_text)
+        return {"text": processed_text, "document_id": doc_id}
+    except ExecutorBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 @app.post("/entities")
-async def extract_entities(data: SummarizeRequest):
+async def extract_entities(data: SummarizeRequest, response: Response, x_profile_token: Optional[str] = Header(None)):
+    denied = profile_denied(x_profile_token)
+    if denied:
+        return denied
     try:
-        entities = find_entities(data.text, language='en')
+        entities = await run_cpu_job(response, x_profile_token, "/entities", find_entities, data.text, language='en')
         # Convert sets to lists for JSON serialization
         entities = {k: list(v) for k, v in entities.items()}
         return {"entities": entities}
+    except ExecutorBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
+@app.get("/api/nlp-models")
+async def nlp_model_status():
+    """Report which SpaCy models are loaded and their memory footprint"""
+    return {"models": nlp_models.stats()}
+
+@app.get("/api/entity-cache")
+async def entity_cache_status():
+    """Report hit and miss counters for the /entities result cache"""
+    return entity_cache.stats()
+
+@app.get("/api/summary-cache")
+async def summary_cache_status():
+    """Report hit and miss counters for the summary cache"""
+    return summary_cache.stats()
+
+@app.get("/api/retrieval")
+async def retrieval_status():
+    """Report how many document indexes are held for follow-up questions"""
+    return retrieval_indexes.stats()
+
+@app.get("/api/sessions")
+async def sessions_status():
+    """Report how many follow-up sessions are held"""
+    return session_store.stats()
+
+@app.get("/api/redact-sessions")
+async def redaction_sessions_status():
+    """Report how many interactive redaction sessions are held"""
+    return redaction_sessions.stats()
+
+@app.get("/api/jobs")
+async def batch_jobs_status():
+    """Report the batch worker pool and how many jobs are running"""
+    return batch_jobs.stats()
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Per-stage latency histograms and LLM timings in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/profiles")
+async def list_profiles(x_profile_token: Optional[str] = Header(None)):
+    """Stored request profiles, newest first; needs the admin token"""
+    if not profiling.authorized(x_profile_token):
+        return JSONResponse(status_code=403, content={"error": PROFILE_FORBIDDEN_ERROR})
+    return {"profiles": await run_in_threadpool(profile_store.list_profiles)}
+
+@app.get("/profiles/{profile_id}")
+async def get_profile(profile_id: str, x_profile_token: Optional[str] = Header(None)):
+    """One request's profile as collapsed stacks, for flamegraph.pl or speedscope"""
+    if not profiling.authorized(x_profile_token):
+        return JSONResponse(status_code=403, content={"error": PROFILE_FORBIDDEN_ERROR})
+    folded = await run_in_threadpool(profile_store.get, profile_id)
+    if folded is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown or evicted profile_id"})
+    return PlainTextResponse(folded)
+
+@app.get("/api/executor")
+async def executor_status():
+    """Report how many CPU-bound jobs are running or queued"""
+    return cpu_executor.stats()
+
+UNKNOWN_REDACTION_SESSION_ERROR = "Unknown or expired redaction session. Start a new one."
+
+def apply_redaction_session(session, entities):
+    """Applies entities in a redaction session, dropping the index of its text once that changes"""
+    edits, redaction_map, version = session.apply(entities)
+    if edits:
+        stale, session.document_id = session.document_id, None
+        if stale:
+            retrieval_indexes.discard(stale)
+    return edits, redaction_map, version
+
 @app.post("/redact")
-async def redact(data: RedactRequest):
+async def redact(data: RedactRequest, response: Response, x_profile_token: Optional[str] = Header(None)):
+    denied = profile_denied(x_profile_token) or namespace_invalid(data.namespace)
+    if denied:
+        return denied
     try:
-        print("=== DEBUG: custom_entities ===")
-        for ce in data.custom_entities:
-            print("Selected:", repr(ce))
-        print("=== DEBUG: text excerpt ===")
-        print(repr(data.text[:1000]))  # print first 1000 chars for context
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("/redact custom_entities: %r", data.custom_entities)
+            logger.debug("/redact text excerpt: %r", data.text[:1000])
         # Merge selected entities and custom_entities into a single redaction target
         merged_entities = dict(data.entities)
         if data.custom_entities:
             # Add a special label for manual selections
             merged_entities.setdefault('MANUAL', [])
             merged_entities['MANUAL'].extend(data.custom_entities)
+        if data.session_id:
+            session = redaction_sessions.get(data.session_id)
+            if session is None:
+                return JSONResponse(status_code=404, content={"error": UNKNOWN_REDACTION_SESSION_ERROR})
+            if data.version is not None and data.version != session.version:
+                return JSONResponse(status_code=409, content={"error": "Redaction session has changed. Fetch its text again.", "version": session.version})
+            # Only entities the session has not applied yet are matched, in
+            # the namespace the session was created with
+            # The session lives in this process, so it is changed here whatever the executor kind
+            edits, redaction_map, version = await run_cpu_job(response, x_profile_token, "/redact", apply_redaction_session,
+                                                              session, merged_entities, local=True)
+            return {"session_id": session.session_id, "version": version, "edits": [list(edit) for edit in edits], "redaction_map": redaction_map}
         # Redact entities in text
-        redacted, redaction_map = redact_text(data.text, merged_entities)
-        # TODO: Store redaction_map in DB
-        return {"redacted_text": redacted, "redaction_map": redaction_map}
+        redacted, redaction_map = await run_cpu_job(response, x_profile_token, "/redact", redact_text, data.text, merged_entities,
+                                                    normalize_namespace(data.namespace), data.include_shared)
+        # The document_id from /upload or /process-text still holds the unredacted text
+        doc_id = await cpu_executor.run_local(reindex_redacted, data.text, redacted)
+        return {"redacted_text": redacted, "redaction_map": redaction_map, "document_id": doc_id}
+    except ExecutorBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
-import openai
-import google.generativeai as genai
+@app.post("/redact-sessions")
+async def create_redaction_session(data: RedactSessionRequest):
+    """Keep a document on the server so /redact calls can send only new entities"""
+    invalid = namespace_invalid(data.namespace)
+    if invalid:
+        return invalid
+    session = redaction_sessions.create(data.text, normalize_namespace(data.namespace), data.include_shared)
+    # The text usually comes from /upload, which indexed it; that index goes stale with the first edit
+    session.document_id = document_id(data.text)
+    return {"session_id": session.session_id, "version": session.version}
+
+@app.get("/redact-sessions/{session_id}")
+async def get_redaction_session(session_id: str):
+    session = redaction_sessions.get(session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": UNKNOWN_REDACTION_SESSION_ERROR})
+    text, version = session.text, session.version
+    try:
+        doc_id = await cpu_executor.run_local(index_document, text)
+    except ExecutorBusy as e:
+        return busy_response(e)
+    # Set before checking the version: an edit from now on discards this index
+    session.document_id = doc_id
+    if session.version != version:
+        retrieval_indexes.discard(doc_id)
+        doc_id = None
+    return {"session_id": session.session_id, "version": version, "text": text, "document_id": doc_id}
+
+@app.delete("/redact-sessions/{session_id}")
+async def delete_redaction_session(session_id: str):
+    redaction_sessions.delete(session_id)
+    return {"success": True}
+
+# Batch anonymization jobs
+def parse_entity_types(entity_types):
+    return [label.strip() for label in entity_types.split(',') if label.strip()] or None
+
+@app.post("/jobs")
+async def create_batch_job(files: List[UploadFile] = File(...), language: str = Form("en"), entity_types: str = Form(""),
+                           namespace: str = Form(""), include_shared: bool = Form(False)):
+    """Anonymize many .pdf/.txt files; entity_types is a comma-separated list of labels"""
+    unsupported = [file.filename for file in files if not is_supported_upload(file.filename)]
+    if unsupported:
+        return JSONResponse(status_code=400, content={"error": UNSUPPORTED_UPLOAD_ERROR, "files": unsupported})
+    invalid = namespace_invalid(namespace)
+    if invalid:
+        return invalid
+    job = batch_jobs.create(language, parse_entity_types(entity_types), normalize_namespace(namespace), include_shared)
+    try:
+        for file in files:
+            # Spool to the job directory; uploads are closed once this request ends
+            await run_in_threadpool(job.add_document, file.filename, file.file)
+    except Exception as e:
+        batch_jobs.delete(job.job_id)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    batch_jobs.start(job)
+    return job.stats()
+
+@app.post("/jobs/texts")
+async def create_batch_text_job(data: BatchTextsRequest):
+    """Anonymize many texts given as {"name", "text"} objects"""
+    invalid = namespace_invalid(data.namespace)
+    if invalid:
+        return invalid
+    job = batch_jobs.create(data.language, data.entity_types, normalize_namespace(data.namespace), data.include_shared)
+    try:
+        for index, document in enumerate(data.documents):
+            await run_in_threadpool(job.add_document, document.get('name') or f"document-{index}", text=document.get('text', ''))
+    except Exception as e:
+        batch_jobs.delete(job.job_id)
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    batch_jobs.start(job)
+    return job.stats()
+
+@app.get("/jobs")
+async def list_batch_jobs():
+    return {"jobs": batch_jobs.list_jobs()}
+
+@app.get("/jobs/{job_id}")
+async def get_batch_job(job_id: str):
+    """Status and progress of a batch job"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job_id"})
+    return job.stats()
+
+@app.get("/jobs/{job_id}/results")
+async def get_batch_job_results(job_id: str):
+    """Per-document results as NDJSON, streamed as they finish until the job ends"""
+    job = batch_jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"error": "Unknown job_id"})
+    response = StreamingResponse(job.follow_results(), media_type="application/x-ndjson")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+@app.delete("/jobs/{job_id}")
+async def delete_batch_job(job_id: str):
+    """Cancel a batch job and delete its results"""
+    batch_jobs.delete(job_id)
+    return {"success": True}
 
 AVAILABLE_MODELS = {
     "GPT-4o": "gpt-4o",
@@ -166,23 +570,17 @@ class APIKeysResponse(BaseModel):
     openai_configured: bool
     gemini_configured: bool
 
-@app.post("/summarize")
-async def summarize(data: SummarizeRequest):
-    api_key = api_keys_store.get('openai_key')
-    # It's good practice to ensure API keys are present, especially if switching between providers
-    # For Gemini, the key is configured globally or per client instance typically.
-
-    model_key = data.model or "GPT-4o" # Default to GPT-4o if not specified
-    model_id = AVAILABLE_MODELS.get(model_key, model_key)
-
-    prompt = f"""
+# Bump SUMMARY_PROMPT_VERSION whenever the template changes so that cached
+# summaries produced by the old prompt are not served
+SUMMARY_PROMPT_VERSION = 1
+SUMMARY_PROMPT_TEMPLATE = """
     You are an AI assistant specialized in summarizing documents and text content.
     Your primary goal is to extract **all critical information** from the content while providing a clear, comprehensive summary.
     
     **CORE TASK:** Analyze and summarize the following document content clearly, concisely, and **completely**.
     
     **DOCUMENT CONTENT:**
-    {data.text}
+    {text}
     
     **ANALYSIS INSTRUCTIONS:**
     1. Read through the **entire document** carefully to understand the main themes and key information.
@@ -200,34 +598,87 @@ async def summarize(data: SummarizeRequest):
     4.  **Conclusions & Recommendations:** List any conclusions drawn, recommendations made, or solutions proposed in the document. If none, state "None".
     5.  **Action Items & Next Steps:** List any specific actions, next steps, or deadlines mentioned in the document. If none, state "None".
     """
-    try:
-        summary = ""
-        if "gpt" in model_id.lower():
-            if not api_key:
-                return JSONResponse(status_code=500, content={"error": "OpenAI API key not set in backend/main.py."})
-            client = openai.OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
+
+def build_summary_prompt(text):
+    return SUMMARY_PROMPT_TEMPLATE.format(text=text)
+
+summary_cache = SummaryCache()
+
+def summary_cache_key(model_id, text, max_tokens=None):
+    # The token limit is part of the key: a 512-token summary is not a
+    # substitute for a 2048-token one
+    return make_summary_key(model_id, f"{SUMMARY_PROMPT_VERSION}:{max_tokens}", text)
+
+async def complete_prompt(model_id, prompt, max_tokens):
+    """
+    Returns the provider's complete (non-streamed) response to a prompt.
+    The caller checks that the model's API key is configured.
+    """
+    if "gpt" in model_id.lower():
+        client = llm_clients.openai(api_keys_store.get('openai_key'))
+        with time_llm('openai', model_id):
+            response = await client.chat.completions.create(
                 model=model_id,
                 messages=[
                     {"role": "system", "content": "You are a helpful assistant."},
                     {"role": "user", "content": prompt}
                 ],
-                max_tokens=512,
+                max_tokens=max_tokens,
                 temperature=0.2
             )
-            summary = response.choices[0].message.content.strip()
+        return response.choices[0].message.content.strip()
+    gemini_model = llm_clients.gemini(api_keys_store.get('gemini_key'), model_id) # Shared, configured once per key
+    with time_llm('gemini', model_id):
+        response = await gemini_model.generate_content_async(prompt) # Use async for FastAPI
+    return response.text
+
+def provider_api_key(model_id):
+    if "gpt" in model_id.lower():
+        return api_keys_store.get('openai_key')
+    if "gemini" in model_id.lower():
+        return api_keys_store.get('gemini_key')
+    return None
+
+@app.post("/summarize")
+async def summarize(data: SummarizeRequest):
+    api_key = api_keys_store.get('openai_key')
+    # It's good practice to ensure API keys are present, especially if switching between providers
+    # For Gemini, the key is configured globally or per client instance typically.
+
+    model_key = data.model or "GPT-4o" # Default to GPT-4o if not specified
+    model_id = AVAILABLE_MODELS.get(model_key, model_key)
+
+    prompt = build_summary_prompt(data.text)
+    cache_key = summary_cache_key(model_id, data.text, 512 if "gpt" in model_id.lower() else None)
+    cached_summary = summary_cache.get(cache_key)
+    if cached_summary is not None:
+        return {"summary": cached_summary, "model": model_id, "cached": True}
+    try:
+        if "gpt" in model_id.lower():
+            if not api_key:
+                return JSONResponse(status_code=500, content={"error": "OpenAI API key not set in backend/main.py."})
         elif "gemini" in model_id.lower():
-            gemini_api_key = api_keys_store.get('gemini_key')
-            if not gemini_api_key:
+            if not api_keys_store.get('gemini_key'):
                 return JSONResponse(status_code=500, content={"error": "Gemini API key not set or is a placeholder in backend/main.py."})
-            genai.configure(api_key=gemini_api_key) # Ensure configured
-            gemini_model = genai.GenerativeModel(model_id)
-            response = await gemini_model.generate_content_async(prompt) # Use async for FastAPI
-            summary = response.text
         else:
             return JSONResponse(status_code=400, content={"error": f"Unsupported model: {model_id}"})
-        
-        return {"summary": summary, "model": model_id}
+
+        sections = 1
+        if needs_map_reduce(data.text):
+            # Too long for one prompt: summarize sections concurrently, then merge
+            section_texts = split_into_sections(data.text)
+            sections = len(section_texts)
+            complete = functools.partial(complete_prompt, model_id)
+            summaries = [None] * sections
+            async with aclosing(iter_section_summaries(section_texts, complete)) as finished:
+                async for index, section_summary in finished:
+                    summaries[index] = section_summary
+            summaries = await collapse_summaries(summaries, complete)
+            prompt = build_summary_prompt(join_section_summaries(summaries))
+
+        summary = await complete_prompt(model_id, prompt, 512)
+        summary_cache.put(cache_key, summary)
+        return {"summary": summary, "model": model_id, "sections": sections}
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
@@ -240,56 +691,60 @@ async def summarize_stream(data: SummarizeRequest):
             openai_api_key = api_keys_store.get('openai_key')
             model_key = data.model or "GPT-4o"
             model_id = AVAILABLE_MODELS.get(model_key, model_key)
-            prompt = f"""
-            You are an AI assistant specialized in summarizing documents and text content.
-            Your primary goal is to extract **all critical information** from the content while providing a clear, comprehensive summary.
-            
-            **CORE TASK:** Analyze and summarize the following document content clearly, concisely, and **completely**.
-            
-            **DOCUMENT CONTENT:**
-            {data.text}
-            
-            **ANALYSIS INSTRUCTIONS:**
-            1. Read through the **entire document** carefully to understand the main themes and key information.
-            2. Identify the most important concepts, facts, conclusions, and insights.
-            3. Focus on substantive content and ignore formatting artifacts, headers, footers, or irrelevant metadata.
-            4. Capture the document's purpose, main arguments, and key findings.
-            5. Note any conclusions, recommendations, or action items mentioned.
-            
-            **REQUIRED SUMMARY OUTPUT:**
-            Provide a comprehensive summary structured as follows:
-            
-            1.  **TLDR:** A single sentence that captures the main point or purpose of the document.
-            2.  **Key Information & Main Points:** Bullet points covering the most important topics, concepts, data points, arguments, or findings discussed in the document.
-            3.  **Supporting Details:** Mention important supporting information, examples, or context that helps understand the main points. If none are significant, state "None".
-            4.  **Conclusions & Recommendations:** List any conclusions drawn, recommendations made, or solutions proposed in the document. If none, state "None".
-            5.  **Action Items & Next Steps:** List any specific actions, next steps, or deadlines mentioned in the document. If none, state "None".
-            """
+            prompt = build_summary_prompt(data.text)
+            cache_key = summary_cache_key(model_id, data.text, 2048 if "gpt" in model_id.lower() else None)
+
+            # Replay a summary we already have instead of asking the provider again
+            cached_summary = summary_cache.get(cache_key)
+            if cached_summary is not None:
+                for piece in replay_chunks(cached_summary):
+                    yield f"data: {json.dumps({'chunk': piece})}\n\n"
+                yield f"data: {json.dumps({'done': True, 'summary': cached_summary, 'model': model_id, 'cached': True})}\n\n"
+                return
+
+            if needs_map_reduce(data.text):
+                if not provider_api_key(model_id):
+                    yield f"data: {json.dumps({'error': f'No API key provided for {model_id}'})}\n\n"
+                    return
+
+                # Too long for one prompt: summarize sections concurrently and
+                # send each section summary as soon as it is ready
+                section_texts = split_into_sections(data.text)
+                sections = len(section_texts)
+                complete = functools.partial(complete_prompt, model_id)
+                yield f"data: {json.dumps({'status': 'mapping', 'message': f'Summarizing {sections} sections...', 'sections': sections})}\n\n"
+
+                summaries = [None] * sections
+                finished_count = 0
+                async with aclosing(iter_section_summaries(section_texts, complete)) as finished:
+                    async for index, section_summary in finished:
+                        summaries[index] = section_summary
+                        finished_count += 1
+                        yield f"data: {json.dumps({'status': 'section', 'message': f'Summarized {finished_count} of {sections} sections...', 'section': index + 1, 'sections': sections, 'partial': section_summary})}\n\n"
+
+                yield f"data: {json.dumps({'status': 'merging', 'message': 'Merging section summaries...'})}\n\n"
+                summaries = await collapse_summaries(summaries, complete)
+                # The merge prompt is streamed below like any other summary
+                prompt = build_summary_prompt(join_section_summaries(summaries))
             
             if "gpt" in model_id.lower():
                 if not openai_api_key:
                     yield f"data: {json.dumps({'error': 'OpenAI API key not provided'})}\n\n"
                     return
                     
-                client = openai.OpenAI(api_key=openai_api_key)
-                stream = client.chat.completions.create(
-                    model=model_id,
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=2048,
-                    temperature=0.2,
-                    stream=True
-                )
-                
+                client = llm_clients.openai(openai_api_key)
+                messages = [
+                    {"role": "system", "content": "You are a helpful assistant."},
+                    {"role": "user", "content": prompt}
+                ]
+
                 full_response = ""
-                for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
+                async with aclosing(stream_openai_chat(client, model_id, messages, max_tokens=2048)) as chunks:
+                    async for content in chunks:
                         full_response += content
                         yield f"data: {json.dumps({'chunk': content})}\n\n"
                         
+                summary_cache.put(cache_key, full_response)
                 yield f"data: {json.dumps({'done': True, 'summary': full_response, 'model': model_id})}\n\n"
                 
             elif "gemini" in model_id.lower():
@@ -302,44 +757,26 @@ async def summarize_stream(data: SummarizeRequest):
                     yield f"data: {json.dumps({'error': 'Gemini API key not provided'})}\n\n"
                     return
                 
-                genai.configure(api_key=gemini_api_key)
-                
                 try:
                     # Use simple original configuration without custom settings
-                    gemini_model = genai.GenerativeModel(model_id)
+                    gemini_model = llm_clients.gemini(gemini_api_key, model_id)
                     
                     # Send another status update
                     yield f"data: {json.dumps({'status': 'generating', 'message': 'Generating response...'})}\n\n"
                     sys.stdout.flush()
                     
                     # Gemini supports streaming!
-                    response = gemini_model.generate_content(prompt, stream=True)
                     full_response = ""
-                    chunk_count = 0
-                    
-                    for chunk in response:
-                        chunk_count += 1
-                        try:
-                            if chunk.text:
-                                full_response += chunk.text
-                                yield f"data: {json.dumps({'chunk': chunk.text})}\n\n"
-                                sys.stdout.flush()
-                                await asyncio.sleep(0)
-                            else:
-                                continue
-                        except ValueError as e:
-                            # Handle safety filter blocks and other chunk access errors
-                            if "finish_reason" in str(e):
-                                print(f"[GEMINI] Chunk #{chunk_count} blocked by safety filter: {e}")
-                                continue
-                            else:
-                                print(f"[GEMINI] Error accessing chunk #{chunk_count}: {e}")
-                                raise e
+                    async with aclosing(stream_gemini(gemini_model, prompt)) as chunks:
+                        async for text in chunks:
+                            full_response += text
+                            yield f"data: {json.dumps({'chunk': text})}\n\n"
                     
+                    summary_cache.put(cache_key, full_response)
                     yield f"data: {json.dumps({'done': True, 'summary': full_response, 'model': model_id})}\n\n"
                     
                 except Exception as gemini_error:
-                    print(f"[GEMINI] ERROR during content generation: {type(gemini_error).__name__}: {str(gemini_error)}")
+                    logger.error("[GEMINI] ERROR during content generation: %s: %s", type(gemini_error).__name__, gemini_error)
                     yield f"data: {json.dumps({'error': f'Gemini API error: {str(gemini_error)}'})}\n\n"
                     return
                 
@@ -353,44 +790,148 @@ async def summarize_stream(data: SummarizeRequest):
     response.headers["X-Accel-Buffering"] = "no"
     return response
 
+# Most recent history messages kept when follow-ups use retrieval
+FOLLOWUP_HISTORY_MESSAGES = int(os.environ.get('FOLLOWUP_HISTORY_MESSAGES', '6'))
+
+FOLLOWUP_CONTEXT_TEMPLATE = """The following excerpts are the parts of a document most relevant to my next question. Answer from them; if they do not contain the answer, say so.
+
+{excerpts}"""
+
+SESSION_SUMMARY_TEMPLATE = """Summary of our conversation so far:
+{summary}"""
+
+def retrieval_context(index, question, recent):
+    """The history message carrying a document's excerpts most relevant to a question"""
+    # The previous question helps with follow-ups like "and what about the second one?"
+    previous_questions = [message['content'] for message in recent if message.get('role') == 'user']
+    query = " ".join(previous_questions[-1:] + [question])
+    excerpts = "\n\n".join(f"[Excerpt {chunk_index + 1}]\n{chunk.strip()}" for chunk_index, chunk in index.search(query))
+    return {"role": "user", "content": FOLLOWUP_CONTEXT_TEMPLATE.format(excerpts=excerpts)}
+
+async def session_history(session, question):
+    """
+    Returns the history to send with a question asked in a server-side
+    session: the document (or its relevant excerpts), the running summary of
+    compacted turns and the recent turns.
+    """
+    history = []
+    if len(session.document) >= RETRIEVAL_MIN_CHARS:
+        _, index = await cpu_executor.run(retrieval_indexes.get_or_build, session.document)
+        history.append(retrieval_context(index, question, session.messages))
+    elif session.document:
+        history.append({"role": "user", "content": session.document})
+    if session.summary:
+        history.append({"role": "user", "content": SESSION_SUMMARY_TEMPLATE.format(summary=session.summary)})
+    return history + list(session.messages)
+
+async def followup_history(data, session=None):
+    """
+    Returns the history to send to the model with a follow-up question.
+
+    Short documents are sent whole, as before. For long documents (found by
+    `document_id`, or sent as the first history message) the document is
+    replaced by its chunks most relevant to the question, and only the
+    last FOLLOWUP_HISTORY_MESSAGES messages of the conversation are kept.
+    """
+    if session is not None:
+        return await session_history(session, data.question)
+    history = list(data.history or [])
+    index = retrieval_indexes.get(data.document_id) if data.document_id else None
+    if index is None:
+        if not history or history[0].get('role') != 'user' or len(history[0].get('content', '')) < RETRIEVAL_MIN_CHARS:
+            return history
+        _, index = await cpu_executor.run(retrieval_indexes.get_or_build, history[0]['content'])
+        history = history[1:]
+
+    recent = history[-FOLLOWUP_HISTORY_MESSAGES:] if FOLLOWUP_HISTORY_MESSAGES > 0 else []
+    return [retrieval_context(index, data.question, recent)] + recent
+
+UNKNOWN_SESSION_ERROR = "Unknown or expired session_id. Start a new session."
+
+async def record_session_turn(session, question, answer):
+    """Stores a finished turn; returns True if the session should now be compacted"""
+    session.add_turn(question, answer)
+    await run_in_threadpool(session_store.save, session)
+    return session.needs_compaction()
+
+async def compact_and_save(session, model_id):
+    """Folds a session's older turns into its running summary using the session's model"""
+    try:
+        if await compact_session(session, functools.partial(complete_prompt, model_id)):
+            await run_in_threadpool(session_store.save, session)
+    except Exception as e:
+        # The turns stay verbatim and compaction is retried after the next turn
+        logger.warning("[SESSIONS] Compaction failed for %s: %s", session.session_id, e)
+
+@app.post("/sessions")
+async def create_session(data: SessionRequest):
+    """Start a server-side follow-up conversation about a document"""
+    document = data.text or ""
+    if data.document_id:
+        index = retrieval_indexes.get(data.document_id)
+        if index is None:
+            return JSONResponse(status_code=404, content={"error": "Unknown document_id. Upload or process the document again."})
+        document = "".join(index.chunks)
+    await run_in_threadpool(session_store.purge_expired)
+    session = await run_in_threadpool(session_store.create, document)
+    return {"session_id": session.session_id}
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    session = await run_in_threadpool(session_store.get, session_id)
+    if session is None:
+        return JSONResponse(status_code=404, content={"error": UNKNOWN_SESSION_ERROR})
+    return {"session_id": session.session_id, "summary": session.summary, "messages": session.messages}
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    await run_in_threadpool(session_store.delete, session_id)
+    return {"success": True}
+
 # New endpoint for follow-up questions
 @app.post("/followup")
-async def followup(data: FollowUpRequest):
+async def followup(data: FollowUpRequest, background_tasks: BackgroundTasks):
     openai_api_key = api_keys_store.get('openai_key')
 
     # Get the actual model name
     model_id = AVAILABLE_MODELS.get(data.model, data.model) # Use data.model which contains the friendly name from frontend
 
+    session = None
+    if data.session_id:
+        session = await run_in_threadpool(session_store.get, data.session_id)
+        if session is None:
+            return JSONResponse(status_code=404, content={"error": UNKNOWN_SESSION_ERROR})
+
     try:
+        history = await followup_history(data, session)
         assistant_response = ""
         if "gpt" in model_id.lower():
             if not openai_api_key:
                 return JSONResponse(status_code=500, content={"error": "OpenAI API key not set in backend/main.py."})
-            client = openai.OpenAI(api_key=openai_api_key)
+            client = llm_clients.openai(openai_api_key)
             # Add the new user question to the history for GPT
-            messages = data.history + [{"role": "user", "content": data.question}]
-            response = client.chat.completions.create(
-                model=model_id,
-                messages=messages,
-                max_tokens=4096,
-                temperature=0.2
-            )
+            messages = history + [{"role": "user", "content": data.question}]
+            with time_llm('openai', model_id):
+                response = await client.chat.completions.create(
+                    model=model_id,
+                    messages=messages,
+                    max_tokens=4096,
+                    temperature=0.2
+                )
             assistant_response = response.choices[0].message.content.strip()
         elif "gemini" in model_id.lower():
             gemini_api_key = api_keys_store.get('gemini_key')
             if not gemini_api_key:
                 return JSONResponse(status_code=500, content={"error": "Gemini API key not set or is a placeholder in backend/main.py."})
-            gemini_api_key = api_keys_store.get('gemini_key')
-            genai.configure(api_key=gemini_api_key)
-            gemini_model = genai.GenerativeModel(model_id)
+            gemini_model = llm_clients.gemini(gemini_api_key, model_id)
             
             # Construct prompt for Gemini from history
             # Gemini's `generate_content` often takes a flat string or specific Content parts.
             # For chat-like interactions, you might use `start_chat` and `send_message` if using the ChatSession.
             # Here, we'll adapt the OpenAI history to a flat string for `generate_content`.
             chat_prompt_parts = []
-            if data.history:
-                for message in data.history:
+            if history:
+                for message in history:
                     if message['role'] == 'user':
                         chat_prompt_parts.append(f"User: {message['content']}")
                     elif message['role'] == 'assistant':
@@ -398,12 +939,18 @@ async def followup(data: FollowUpRequest):
             chat_prompt_parts.append(f"User: {data.question}")
             full_prompt = "\n".join(chat_prompt_parts)
 
-            response = await gemini_model.generate_content_async(full_prompt) # Use async
+            with time_llm('gemini', model_id):
+                response = await gemini_model.generate_content_async(full_prompt) # Use async
             assistant_response = response.text
         else:
             return JSONResponse(status_code=400, content={"error": f"Unsupported model: {model_id}"})
 
+        if session is not None and await record_session_turn(session, data.question, assistant_response):
+            # Summarize older turns after the answer has been sent
+            background_tasks.add_task(compact_and_save, session, model_id)
         return {"answer": assistant_response, "model": model_id}
+    except ExecutorBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
@@ -415,37 +962,38 @@ async def followup_stream(data: FollowUpRequest):
             openai_api_key = api_keys_store.get('openai_key')
             model_key = data.model or "GPT-4o"
             model_id = AVAILABLE_MODELS.get(model_key, model_key)
+            session = None
+            if data.session_id:
+                session = await run_in_threadpool(session_store.get, data.session_id)
+                if session is None:
+                    yield f"data: {json.dumps({'error': UNKNOWN_SESSION_ERROR})}\n\n"
+                    return
+            history = await followup_history(data, session)
             
             if "gpt" in model_id.lower():
                 if not openai_api_key:
                     yield f"data: {json.dumps({'error': 'OpenAI API key not provided'})}\n\n"
                     return
                     
-                client = openai.OpenAI(api_key=openai_api_key)
+                client = llm_clients.openai(openai_api_key)
                 
                 # Build messages from history
                 messages = []
-                if data.history:
-                    for message in data.history:
+                if history:
+                    for message in history:
                         messages.append({"role": message['role'], "content": message['content']})
                 messages.append({"role": "user", "content": data.question})
                 
-                stream = client.chat.completions.create(
-                    model=model_id,
-                    messages=messages,
-                    max_tokens=4096,
-                    temperature=0.2,
-                    stream=True
-                )
-                
                 full_response = ""
-                for chunk in stream:
-                    if chunk.choices[0].delta.content:
-                        content = chunk.choices[0].delta.content
+                async with aclosing(stream_openai_chat(client, model_id, messages, max_tokens=4096)) as chunks:
+                    async for content in chunks:
                         full_response += content
                         yield f"data: {json.dumps({'chunk': content})}\n\n"
                         
                 yield f"data: {json.dumps({'done': True, 'answer': full_response, 'model': model_id})}\n\n"
+                if session is not None and await record_session_turn(session, data.question, full_response):
+                    # The answer is already out; summarize older turns before closing the stream
+                    await compact_and_save(session, model_id)
                 
             elif "gemini" in model_id.lower():
                 # Send immediate "thinking" indicator
@@ -457,16 +1005,14 @@ async def followup_stream(data: FollowUpRequest):
                     yield f"data: {json.dumps({'error': 'Gemini API key not provided'})}\n\n"
                     return
                 
-                genai.configure(api_key=gemini_api_key)
-                
                 try:
                     # Use simple original configuration without custom settings
-                    gemini_model = genai.GenerativeModel(model_id)
+                    gemini_model = llm_clients.gemini(gemini_api_key, model_id)
                     
                     # Construct prompt from history
                     chat_prompt_parts = []
-                    if data.history:
-                        for message in data.history:
+                    if history:
+                        for message in history:
                             if message['role'] == 'user':
                                 chat_prompt_parts.append(f"User: {message['content']}")
                             elif message['role'] == 'assistant':
@@ -479,33 +1025,19 @@ async def followup_stream(data: FollowUpRequest):
                     sys.stdout.flush()
                     
                     # Use streaming for Gemini
-                    response = gemini_model.generate_content(full_prompt, stream=True)
                     full_response = ""
-                    chunk_count = 0
-                    
-                    for chunk in response:
-                        chunk_count += 1
-                        try:
-                            if chunk.text:
-                                full_response += chunk.text
-                                yield f"data: {json.dumps({'chunk': chunk.text})}\n\n"
-                                sys.stdout.flush()
-                                await asyncio.sleep(0)
-                            else:
-                                continue
-                        except ValueError as e:
-                            # Handle safety filter blocks and other chunk access errors
-                            if "finish_reason" in str(e):
-                                print(f"[GEMINI FOLLOWUP-STREAM] Chunk #{chunk_count} blocked by safety filter: {e}")
-                                continue
-                            else:
-                                print(f"[GEMINI FOLLOWUP-STREAM] Error accessing chunk #{chunk_count}: {e}")
-                                raise e
+                    async with aclosing(stream_gemini(gemini_model, full_prompt, log_prefix="GEMINI FOLLOWUP-STREAM")) as chunks:
+                        async for text in chunks:
+                            full_response += text
+                            yield f"data: {json.dumps({'chunk': text})}\n\n"
                     
                     yield f"data: {json.dumps({'done': True, 'answer': full_response, 'model': model_id})}\n\n"
+                    if session is not None and await record_session_turn(session, data.question, full_response):
+                        # The answer is already out; summarize older turns before closing the stream
+                        await compact_and_save(session, model_id)
                     
                 except Exception as gemini_error:
-                    print(f"[GEMINI FOLLOWUP-STREAM] ERROR during content generation: {type(gemini_error).__name__}: {str(gemini_error)}")
+                    logger.error("[GEMINI FOLLOWUP-STREAM] ERROR during content generation: %s: %s", type(gemini_error).__name__, gemini_error)
                     yield f"data: {json.dumps({'error': f'Gemini API error: {str(gemini_error)}'})}\n\n"
                     return
                 
@@ -521,10 +1053,16 @@ async def followup_stream(data: FollowUpRequest):
 
 @app.post("/deanonymize")
 async def deanonymize(data: DeanonymizeRequest):
+    invalid = namespace_invalid(data.namespace)
+    if invalid:
+        return invalid
     try:
         # Use the new function that queries the DB directly
-        deanonymized = deanonymize_using_db(data.text)
+        deanonymized = await cpu_executor.run(deanonymize_using_db, data.text, namespace=normalize_namespace(data.namespace),
+                                              include_shared=data.include_shared)
         return {"text": deanonymized}
+    except ExecutorBusy as e:
+        return busy_response(e)
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
@@ -548,6 +1086,8 @@ async def configure_api_keys(data: APIKeysRequest):
     
     # Save to persistent storage
     save_api_keys(api_keys_store)
+    # Rebuild provider clients only for keys that actually changed
+    await llm_clients.retain(api_keys_store.get('openai_key'), api_keys_store.get('gemini_key'))
     
     return APIKeysResponse(
         openai_configured=bool(api_keys_store.get('openai_key')),
@@ -568,6 +1108,7 @@ async def clear_api_keys():
     global api_keys_store
     api_keys_store = {}
     save_api_keys(api_keys_store)
+    await llm_clients.retain()
     
     # Remove the file if it exists
     if API_KEYS_FILE.exists():
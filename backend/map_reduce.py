@@ -0,0 +1,127 @@
+# map_reduce.py
+# Map-reduce summarization for documents that do not fit in one prompt: the
+# text is split into token-budgeted sections that are summarized concurrently,
+# and the section summaries are then merged by a final prompt.
+import asyncio
+import os
+
+from utils import split_into_chunks
+
+# Token budget of the document text in each map prompt; longer documents use map-reduce
+SUMMARY_CHUNK_TOKENS = int(os.environ.get('SUMMARY_CHUNK_TOKENS', '12000'))
+# Section summaries requested from the provider at the same time
+SUMMARY_MAP_CONCURRENCY = int(os.environ.get('SUMMARY_MAP_CONCURRENCY', '4'))
+# Max tokens the provider may spend on each section summary
+SUMMARY_SECTION_MAX_TOKENS = int(os.environ.get('SUMMARY_SECTION_MAX_TOKENS', '700'))
+# Rough characters-per-token ratio for English text; avoids shipping a tokenizer
+CHARS_PER_TOKEN = 4
+
+SECTION_PROMPT_TEMPLATE = """
+    You are summarizing one section of a longer document that is being processed in parts.
+    This is section {index} of {total}.
+
+    **SECTION CONTENT:**
+    {text}
+
+    **INSTRUCTIONS:**
+    Write a dense summary of this section only, as bullet points. Keep every fact that
+    could matter for the whole document: names, figures, dates, decisions, conclusions,
+    recommendations, action items and deadlines. Do not add an introduction or a TLDR.
+    """
+
+def estimate_tokens(text):
+    """
+    Estimates the number of tokens in `text` from its length.
+    """
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+def needs_map_reduce(text, chunk_tokens=None):
+    """
+    Returns True if `text` is over the single-prompt token budget.
+    """
+    chunk_tokens = chunk_tokens or SUMMARY_CHUNK_TOKENS
+    return estimate_tokens(text) > chunk_tokens
+
+def split_into_sections(text, chunk_tokens=None):
+    """
+    Splits `text` into sections of at most `chunk_tokens` estimated tokens,
+    breaking on paragraph boundaries where possible.
+
+    Returns:
+        list: The section texts, in document order.
+    """
+    chunk_tokens = chunk_tokens or SUMMARY_CHUNK_TOKENS
+    return [chunk for _, chunk in split_into_chunks(text, chunk_tokens * CHARS_PER_TOKEN)]
+
+def build_section_prompt(text, index, total):
+    return SECTION_PROMPT_TEMPLATE.format(text=text, index=index, total=total)
+
+def join_section_summaries(summaries):
+    """
+    Joins section summaries, in order, into the text of a merge prompt.
+    """
+    total = len(summaries)
+    parts = [
+        "The document was too long to read at once. Below are summaries of its "
+        "consecutive sections, in order; treat them together as the document."
+    ]
+    for index, summary in enumerate(summaries, 1):
+        parts.append(f"### Section {index} of {total}\n{summary.strip()}")
+    return "\n\n".join(parts)
+
+async def iter_section_summaries(sections, complete, concurrency=None):
+    """
+    Summarizes sections concurrently, at most `concurrency` at a time, and
+    yields each summary as soon as it is ready.
+
+    Args:
+        sections (list): Section texts in document order.
+        complete: Async callable taking (prompt, max_tokens) and returning the
+            provider's response text.
+        concurrency (int): Maximum calls in flight. Defaults to SUMMARY_MAP_CONCURRENCY.
+
+    Yields:
+        tuple: (index, summary) in completion order, with index starting at 0.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency or SUMMARY_MAP_CONCURRENCY))
+    total = len(sections)
+
+    async def summarize_section(index, section):
+        async with semaphore:
+            summary = await complete(build_section_prompt(section, index + 1, total), SUMMARY_SECTION_MAX_TOKENS)
+        return index, summary
+
+    tasks = [asyncio.ensure_future(summarize_section(index, section)) for index, section in enumerate(sections)]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # A failed section or a disconnected client stops the remaining calls
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+async def collapse_summaries(summaries, complete, chunk_tokens=None, concurrency=None):
+    """
+    Re-summarizes groups of section summaries until all of them fit in one
+    prompt. Only very long documents need this step.
+
+    Returns:
+        list: Section summaries, in document order, that fit the token budget.
+    """
+    chunk_tokens = chunk_tokens or SUMMARY_CHUNK_TOKENS
+    while len(summaries) > 1 and estimate_tokens(join_section_summaries(summaries)) > chunk_tokens:
+        groups = []
+        for summary in summaries:
+            if groups and estimate_tokens("\n\n".join(groups[-1] + [summary])) <= chunk_tokens:
+                groups[-1].append(summary)
+            else:
+                groups.append([summary])
+        if len(groups) == len(summaries):
+            # Every summary already fills the budget on its own; merging cannot shrink them further
+            break
+        collapsed = [None] * len(groups)
+        async for index, summary in iter_section_summaries(["\n\n".join(group) for group in groups], complete, concurrency):
+            collapsed[index] = summary
+        summaries = collapsed
+    return summaries
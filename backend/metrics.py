@@ -0,0 +1,211 @@
+# metrics.py
+# Per-stage latency histograms and throughput counters, served in the
+# Prometheus text format by GET /metrics. Dependency-free; values are kept
+# per process, so each uvicorn worker (and each batch worker process) reports
+# only its own work.
+import asyncio
+import functools
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Set to 0 to skip stage timing entirely
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') != '0'
+
+# Seconds; covers sub-millisecond regex passes up to multi-minute LLM streams
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+_registry = []
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """
+    Monotonic counter with optional labels, passed to inc() by keyword.
+    """
+    kind = 'counter'
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+class Histogram:
+    """
+    Histogram with fixed buckets and optional labels, passed to observe()
+    by keyword.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # Per-bucket counts (not cumulative), then sum and count
+                series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            snapshot = {key: (list(counts), total, count) for key, (counts, total, count) in self._series.items()}
+        for key, (counts, total, count) in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, [('le', _format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key, [('le', '+Inf')])
+            yield f"{self.name}_bucket{labels} {count}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+stage_seconds = Histogram('obfuscator_stage_seconds', 'Time spent in each pipeline stage', ('stage',))
+stage_input_size = Counter('obfuscator_stage_input_size_total',
+                           'Input processed by each pipeline stage: bytes for upload_read and '
+                           'pdf_extraction, characters for the others', ('stage',))
+llm_seconds = Histogram('obfuscator_llm_seconds', 'Total time of LLM provider calls',
+                        ('provider', 'model', 'mode'))
+llm_first_token_seconds = Histogram('obfuscator_llm_time_to_first_token_seconds',
+                                    'Time from starting an LLM stream to its first text chunk',
+                                    ('provider', 'model'))
+llm_requests = Counter('obfuscator_llm_requests_total', 'LLM provider calls by outcome',
+                       ('provider', 'model', 'mode', 'outcome'))
+
+def observe_stage(stage, seconds, size=None):
+    stage_seconds.observe(seconds, stage=stage)
+    if size is not None:
+        stage_input_size.inc(size, stage=stage)
+
+@contextmanager
+def time_stage(stage, size=None):
+    """
+    Times the body of a `with` block as one run of `stage`; `size` is the
+    amount of input it processed.
+    """
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start, size)
+
+def timed(stage):
+    """
+    Decorator timing every call of a function as `stage`, counting the
+    length of its first argument (text or bytes) as the input size.
+    """
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(data, *args, **kwargs):
+            if not METRICS_ENABLED:
+                return fn(data, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(data, *args, **kwargs)
+            finally:
+                observe_stage(stage, time.perf_counter() - start, len(data))
+        return wrapper
+    return decorate
+
+def _outcome(exc_type):
+    if exc_type is None:
+        return 'ok'
+    if issubclass(exc_type, (GeneratorExit, asyncio.CancelledError)):
+        # The client went away or the consumer stopped reading
+        return 'cancelled'
+    return 'error'
+
+class LLMTimer:
+    """
+    Records one LLM provider call. Streams call first_chunk() as text
+    arrives; everything calls finish() once done.
+    """
+    def __init__(self, provider, model, mode):
+        self.provider = provider
+        self.model = model
+        self.mode = mode
+        self.started = time.perf_counter()
+        self._first_seen = False
+
+    def first_chunk(self):
+        if not self._first_seen:
+            self._first_seen = True
+            if METRICS_ENABLED:
+                llm_first_token_seconds.observe(time.perf_counter() - self.started,
+                                                provider=self.provider, model=self.model)
+
+    def finish(self, exc_type=None):
+        if not METRICS_ENABLED:
+            return
+        llm_seconds.observe(time.perf_counter() - self.started,
+                            provider=self.provider, model=self.model, mode=self.mode)
+        llm_requests.inc(provider=self.provider, model=self.model, mode=self.mode, outcome=_outcome(exc_type))
+
+@contextmanager
+def time_llm(provider, model, mode='complete'):
+    """
+    Times a non-streamed LLM call made inside a `with` block.
+    """
+    timer = LLMTimer(provider, model, mode)
+    try:
+        yield timer
+    except BaseException as e:
+        timer.finish(type(e))
+        raise
+    timer.finish()
+
+def render():
+    """
+    Returns every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,182 @@
+# profiling.py
+# Opt-in profiling of single requests. When PROFILE_ADMIN_TOKEN is set, a
+# request carrying it in the X-Profile-Token header has its CPU-bound work
+# sampled; the stacks are stored in collapsed ("folded") format, one
+# "frame;frame;frame count" line per stack, which flamegraph.pl, speedscope
+# and similar tools read directly. Requests without the header never touch
+# this module.
+import hmac
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+
+# Profiling is unavailable unless this is set
+PROFILE_ADMIN_TOKEN = os.environ.get('PROFILE_ADMIN_TOKEN', '')
+# Where profiles are kept
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'obfuscator-profiles'))
+# Profiles kept on disk; the oldest are deleted beyond this
+PROFILE_MAX = int(os.environ.get('PROFILE_MAX', '50'))
+# Seconds between stack samples
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', '0.002'))
+
+_PROFILE_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+def authorized(token):
+    """
+    True if profiling is enabled and `token` is the admin token.
+    """
+    return bool(PROFILE_ADMIN_TOKEN) and bool(token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """
+    Samples one thread's Python stack from a background thread.
+
+    A sample is weighted by the time since the previous one, so time spent
+    in C code that holds the GIL (regex passes, PDF parsing) still counts
+    toward the Python frame that called it.
+    """
+    def __init__(self, thread_id, root_code, interval=PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.root_code = root_code
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def _run(self):
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            weight = max(1, round((now - last) / self.interval))
+            last = now
+            stack = []
+            # Stop at the profiled call; the executor frames below it are noise
+            while frame is not None and frame.f_code is not self.root_code:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.counts[';'.join(reversed(stack))] += weight
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def folded(self):
+        """
+        Returns the samples in collapsed-stack format, heaviest stacks first.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.counts.most_common())
+
+def run_profiled(fn, *args, **kwargs):
+    """
+    Runs fn(*args, **kwargs) in this thread while sampling its stack. Meant
+    to be submitted to the CPU executor in place of fn.
+
+    Returns:
+        tuple: (fn's result, folded stacks, seconds taken)
+    """
+    sampler = StackSampler(threading.get_ident(), run_profiled.__code__)
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        seconds = time.perf_counter() - start
+        sampler.stop()
+    return result, sampler.folded(), seconds
+
+class ProfileStore:
+    """
+    Ring buffer of profiles on disk: <id>.folded holds the stacks and
+    <id>.json what was profiled. Saving beyond `max_profiles` deletes the
+    oldest.
+    """
+    def __init__(self, directory=PROFILE_DIR, max_profiles=PROFILE_MAX):
+        self.directory = directory
+        self.max_profiles = max_profiles
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id, extension):
+        return os.path.join(self.directory, f"{profile_id}.{extension}")
+
+    def save(self, endpoint, folded, seconds):
+        """
+        Stores a profile and returns its id.
+        """
+        profile_id = uuid.uuid4().hex
+        meta = {
+            'profile_id': profile_id,
+            'endpoint': endpoint,
+            'created_at': time.time(),
+            'seconds': round(seconds, 4),
+            'samples': sum(int(line.rsplit(' ', 1)[1]) for line in folded.splitlines()),
+            'interval': PROFILE_SAMPLE_INTERVAL,
+        }
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(profile_id, 'folded'), 'w', encoding='utf-8') as f:
+                f.write(folded)
+            # Metadata last: a profile is listed only once its stacks are written
+            partial = self._path(profile_id, 'json.partial')
+            with open(partial, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+            os.replace(partial, self._path(profile_id, 'json'))
+            self._prune()
+        return profile_id
+
+    def _prune(self):
+        profiles = self.list_profiles()
+        for meta in profiles[self.max_profiles:]:
+            for extension in ('json', 'folded'):
+                try:
+                    os.remove(self._path(meta['profile_id'], extension))
+                except FileNotFoundError:
+                    pass
+
+    def list_profiles(self):
+        """
+        Returns the metadata of every stored profile, newest first.
+        """
+        profiles = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return profiles
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        profiles.sort(key=lambda meta: meta['created_at'], reverse=True)
+        return profiles
+
+    def get(self, profile_id):
+        """
+        Returns the folded stacks of a profile, or None if it is unknown or
+        has been evicted.
+        """
+        if not _PROFILE_ID_RE.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id, 'folded'), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+profile_store = ProfileStore()
@@ -0,0 +1,174 @@
+# redact_cli.py
+# Redacts a directory tree of .pdf and .txt files without the web server:
+#
+#   python redact_cli.py INPUT_DIR OUTPUT_DIR [--workers N] [--language en]
+#                        [--entity-types PERSON,ORG] [--db redactions.db]
+#
+# Each input is written to OUTPUT_DIR/<relative path>.redacted.txt and recorded
+# in OUTPUT_DIR/manifest.jsonl. Re-running after an interruption skips files
+# whose content hash the manifest already lists as done.
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import redactor
+from extraction import SUPPORTED_EXTENSIONS
+from jobs import init_worker, analyze_in_pool, redact_analyzed
+
+MANIFEST_NAME = 'manifest.jsonl'
+OUTPUT_SUFFIX = '.redacted.txt'
+# Seconds between progress lines
+PROGRESS_INTERVAL = 5.0
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def find_documents(input_dir, output_dir):
+    """
+    Returns the relative paths of supported files under input_dir, sorted,
+    leaving out anything inside output_dir.
+    """
+    output_dir = os.path.abspath(output_dir)
+    found = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(root, d)) != output_dir)
+        for name in files:
+            if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                found.append(os.path.relpath(os.path.join(root, name), input_dir))
+    return sorted(found)
+
+def load_manifest(path):
+    """
+    Returns {sha256: output path} for every document the manifest records as done.
+    A line cut short by an interruption is ignored.
+    """
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if entry.get('status') == 'ok':
+                done[entry['sha256']] = entry['output']
+    return done
+
+def write_output(path, text):
+    # Write then rename, so an interrupted run never leaves a partial output
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = path + '.partial'
+    with open(partial, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(partial, path)
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.processed = 0
+        self.failed = 0
+        self.started_at = time.time()
+        self._last_report = self.started_at
+
+    def rate(self):
+        elapsed = time.time() - self.started_at
+        return self.processed / elapsed if elapsed else 0.0
+
+    def update(self, failed=False):
+        self.processed += 1
+        self.failed += failed
+        now = time.time()
+        if now - self._last_report >= PROGRESS_INTERVAL or self.processed == self.total:
+            self._last_report = now
+            print(f"[CLI] {self.processed}/{self.total} documents, {self.failed} failed, {self.rate():.2f} docs/s")
+
+def run(args):
+    if args.db:
+        redactor._DB_PATH = os.path.abspath(args.db)
+    entity_types = set(args.entity_types.split(',')) if args.entity_types else None
+    namespace = redactor.normalize_namespace(args.namespace)
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+    done = load_manifest(manifest_path)
+
+    documents = []
+    skipped = 0
+    with open(manifest_path, 'a', encoding='utf-8') as manifest:
+        def record(entry):
+            manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+
+        for relative_path in find_documents(args.input_dir, args.output_dir):
+            path = os.path.join(args.input_dir, relative_path)
+            sha256 = file_digest(path)
+            output = relative_path + OUTPUT_SUFFIX
+            previous = done.get(sha256)
+            if previous is not None and os.path.exists(os.path.join(args.output_dir, previous)):
+                if previous != output:
+                    # Same content under another name: reuse the earlier output
+                    os.makedirs(os.path.dirname(os.path.join(args.output_dir, output)), exist_ok=True)
+                    shutil.copyfile(os.path.join(args.output_dir, previous), os.path.join(args.output_dir, output))
+                    record({'path': relative_path, 'sha256': sha256, 'output': output, 'status': 'ok', 'reused': previous})
+                skipped += 1
+                continue
+            documents.append({'name': os.path.basename(path), 'path': path, 'is_text': False,
+                              'relative_path': relative_path, 'sha256': sha256, 'output': output})
+
+        print(f"[CLI] {len(documents)} to process, {skipped} already done, {args.workers} workers")
+        if not documents:
+            return 0
+
+        progress = Progress(len(documents))
+        pool = ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker)
+        try:
+            # Redaction happens here, in one process, so all documents share
+            # the same tags for the same entities
+            for _, document, future in analyze_in_pool(pool, documents, args.language, args.workers * 2):
+                entry = {'path': document['relative_path'], 'sha256': document['sha256'], 'output': document['output']}
+                try:
+                    text, entities = future.result()
+                    redacted, _, selected = redact_analyzed(text, entities, entity_types, namespace, args.include_shared)
+                    write_output(os.path.join(args.output_dir, document['output']), redacted)
+                    entry.update(status='ok', entities={label: len(values) for label, values in selected.items()})
+                except Exception as e:
+                    entry.update(status='error', error=str(e))
+                record(entry)
+                progress.update(failed=entry['status'] == 'error')
+        except KeyboardInterrupt:
+            print(f"\n[CLI] Interrupted after {progress.processed} documents; run again to resume")
+            pool.shutdown(wait=False, cancel_futures=True)
+            return 130
+        pool.shutdown()
+
+    print(f"[CLI] Done: {progress.processed - progress.failed} redacted, {progress.failed} failed, "
+          f"{skipped} skipped in {time.time() - progress.started_at:.1f}s ({progress.rate():.2f} docs/s)")
+    return 1 if progress.failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Redact every .pdf and .txt file under a directory.")
+    parser.add_argument('input_dir', help="Directory tree to read documents from")
+    parser.add_argument('output_dir', help="Directory for redacted outputs and the manifest")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="Worker processes (default: CPU count)")
+    parser.add_argument('--language', default='en', help="Language of the documents: en or pt (default: en)")
+    parser.add_argument('--entity-types', default='', help="Comma-separated labels to redact, e.g. PERSON,ORG (default: all)")
+    parser.add_argument('--db', default='', help="Redaction database to use (default: backend/redactions.db)")
+    parser.add_argument('--namespace', default='', help="Redaction namespace, e.g. a matter or tenant ID (default: shared)")
+    parser.add_argument('--include-shared', action='store_true', help="Also apply and reuse the shared namespace's redactions")
+    args = parser.parse_args(argv)
+    # Model loading and job errors are logged by the backend modules
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(name)s: %(message)s')
+    return run(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
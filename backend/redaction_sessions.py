@@ -0,0 +1,152 @@
+# redaction_sessions.py
+# Interactive redaction without resending the document. A session holds the
+# current redacted text and the positions of the tags in it; each /redact call
+# applies only entities the session has not seen yet and answers with the
+# edits it made instead of the whole document.
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from redactor import build_redaction_matcher, _ANON_TAG_RE, SHARED_NAMESPACE
+
+# Redaction sessions kept in memory
+REDACTION_SESSION_MAX = int(os.environ.get('REDACTION_SESSION_MAX', '64'))
+# Seconds of inactivity after which a redaction session is dropped
+REDACTION_SESSION_TTL = float(os.environ.get('REDACTION_SESSION_TTL', '3600'))
+
+class RedactionSession:
+    """
+    The current redacted text of one document plus a sorted index of the
+    tag spans in it, so new matches never land inside an existing tag.
+    Tags come from, and are stored in, the session's redaction namespace.
+    """
+    def __init__(self, session_id, text, namespace=SHARED_NAMESPACE, include_shared=False):
+        self.session_id = session_id
+        self.text = text
+        self.namespace = namespace
+        self.include_shared = include_shared
+        self.version = 0
+        self.applied = set()
+        # Id under which the current text is indexed for follow-up questions, if any
+        self.document_id = None
+        self.updated_at = time.time()
+        self._tag_starts = []
+        self._tag_ends = []
+        for match in _ANON_TAG_RE.finditer(text):
+            self._tag_starts.append(match.start())
+            self._tag_ends.append(match.end())
+        self._lock = threading.Lock()
+
+    def _splice(self, matches):
+        # One pass over the matches and the existing tag spans, both in text
+        # order: matches overlapping a tag are dropped, the rest are spliced
+        # in, and the tag spans are shifted by the edits before them
+        tag_starts, tag_ends = self._tag_starts, self._tag_ends
+        new_starts = []
+        new_ends = []
+        edits = []
+        pieces = []
+        position = 0
+        shift = 0
+        index = 0
+        for start, end, tag in matches:
+            while index < len(tag_starts) and tag_ends[index] <= start:
+                new_starts.append(tag_starts[index] + shift)
+                new_ends.append(tag_ends[index] + shift)
+                index += 1
+            if index < len(tag_starts) and tag_starts[index] < end:
+                continue
+            pieces.append(self.text[position:start])
+            pieces.append(tag)
+            new_starts.append(start + shift)
+            new_ends.append(start + shift + len(tag))
+            shift += len(tag) - (end - start)
+            position = end
+            edits.append((start, end, tag))
+        for index in range(index, len(tag_starts)):
+            new_starts.append(tag_starts[index] + shift)
+            new_ends.append(tag_ends[index] + shift)
+
+        if edits:
+            pieces.append(self.text[position:])
+            self.text = "".join(pieces)
+            self._tag_starts, self._tag_ends = new_starts, new_ends
+        return edits
+
+    def apply(self, entities):
+        """
+        Redacts the entities this session has not applied yet. CPU-bound; run
+        it in the executor.
+
+        Args:
+            entities (dict): Entity type -> list of entities, as for redact_text().
+
+        Returns:
+            tuple: (edits, redaction_map, version). `edits` lists
+            (start, end, tag) replacements in the previous version's
+            coordinates, in ascending order.
+        """
+        with self._lock:
+            new_entities = {}
+            for entity_type, entity_set in entities.items():
+                manual = entity_type == 'MANUAL'
+                for entity in entity_set:
+                    if entity and (entity, manual) not in self.applied:
+                        new_entities.setdefault(entity_type, []).append(entity)
+            self.updated_at = time.time()
+            if not new_entities:
+                return [], {}, self.version
+
+            matcher, redaction_map = build_redaction_matcher(new_entities, self.namespace, self.include_shared)
+            edits = self._splice(matcher.spans(self.text))
+            if edits:
+                self.version += 1
+            for entity_type, entity_set in new_entities.items():
+                self.applied.update((entity, entity_type == 'MANUAL') for entity in entity_set)
+            return edits, redaction_map, self.version
+
+class RedactionSessionStore:
+    """
+    Size-bounded LRU of redaction sessions that expire after `ttl` seconds
+    of inactivity.
+    """
+    def __init__(self, max_sessions=REDACTION_SESSION_MAX, ttl=REDACTION_SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, text, namespace=SHARED_NAMESPACE, include_shared=False):
+        session = RedactionSession(uuid.uuid4().hex, text, namespace, include_shared)
+        with self._lock:
+            self._sessions[session.session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if self.ttl > 0 and session.updated_at + self.ttl < time.time():
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'ttl': self.ttl,
+            'characters': sum(len(session.text) for session in list(self._sessions.values())),
+        }
+
+redaction_sessions = RedactionSessionStore()
@@ -3,149 +3,1035 @@ import re
 import uuid
 import sqlite3
 import os
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from metrics import timed
+
+logger = logging.getLogger(__name__)
 
 # Determine the absolute path to the directory containing this script
 _BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Construct the absolute path to the database file
 _DB_PATH = os.path.join(_BASE_DIR, 'redactions.db')
+# How often (in seconds) the in-memory vocabulary checks the DB for writes
+# made by other processes. Writes made by this process are seen immediately.
+VOCABULARY_CHECK_INTERVAL = float(os.environ.get('REDACTION_VOCABULARY_CHECK_INTERVAL', '1.0'))
+# Maximum number of open SQLite connections per database file
+DB_POOL_SIZE = int(os.environ.get('REDACTION_DB_POOL_SIZE', '8'))
+# Seconds to wait for a pooled connection or a write lock before failing
+DB_TIMEOUT = float(os.environ.get('REDACTION_DB_TIMEOUT', '30'))
+# Namespace vocabularies kept in memory; the least recently used beyond this are reloaded on demand
+REDACTION_NAMESPACE_CACHE = int(os.environ.get('REDACTION_NAMESPACE_CACHE', '64'))
+# Characters the streaming pipeline carries from one window into the next, so
+# matches and HTML tags spanning a window edge are still found
+STREAM_OVERLAP_CHARS = int(os.environ.get('STREAM_OVERLAP_CHARS', '4096'))
+
+_MAX_SQL_VARIABLES = 900
+
+_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-16000',
+    f'PRAGMA busy_timeout={int(DB_TIMEOUT * 1000)}',
+)
+
+class ConnectionPool:
+    """
+    Thread-safe pool of long-lived SQLite connections to one database file.
+
+    Connections are opened lazily up to `size`, configured for WAL so
+    readers never block the writer, and handed out one thread at a time.
+    """
+    def __init__(self, path, size=DB_POOL_SIZE, timeout=DB_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._opened = 0
+
+    def _connect(self):
+        logger.debug("[DB] Connecting to: %s", self.path)
+        conn = sqlite3.connect(self.path, timeout=self.timeout, check_same_thread=False)
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._opened -= 1
+                    raise
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"Timed out waiting for a connection to {self.path}")
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    def close_all(self):
+        with self._lock:
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except queue.Empty:
+                    break
+                self._opened -= 1
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=None):
+    """
+    Returns the shared connection pool for a database file, creating it
+    (and the schema) on first use.
+    """
+    path = path or _DB_PATH
+    pool = _pools.get(path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(path)
+            if pool is None:
+                pool = ConnectionPool(path)
+                redaction_db = RedactionDatabase(pool)
+                try:
+                    redaction_db.create_table()
+                finally:
+                    redaction_db.close()
+                _pools[path] = pool
+    return pool
+
+# Pools inherited over a fork; kept referenced so the child never closes them
+_inherited_pools = []
+
+def _reset_after_fork():
+    """
+    Runs in a forked child (e.g. a CPU or batch worker process). SQLite
+    connections must not be used across a fork, so the child opens its own;
+    locks another parent thread held at fork time are replaced too.
+    """
+    global _pools, _pools_lock, _vocabularies, _tag_lock
+    _inherited_pools.append(_pools)
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _vocabularies = VocabularyRegistry()
+    _tag_lock = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _lookup_key(original):
+    # Matching is case-insensitive, so case variants share one lookup key
+    return original.lower()
+
+# Redactions stored without a namespace; other namespaces may opt in to it
+SHARED_NAMESPACE = ''
+_MAX_NAMESPACE_LENGTH = 200
+
+def normalize_namespace(namespace):
+    """
+    Returns the namespace to store and match redactions under: '' (the
+    shared vocabulary) for None or blank, otherwise the stripped name.
+    """
+    namespace = (namespace or '').strip()
+    if len(namespace) > _MAX_NAMESPACE_LENGTH:
+        raise ValueError(f"Namespace must be at most {_MAX_NAMESPACE_LENGTH} characters.")
+    return namespace
+
+def _mint_tag():
+    return f"<ANON_{uuid.uuid4().hex[:8]}>"
+
+def _generation_key(namespace):
+    return 'generation' if namespace == SHARED_NAMESPACE else f'generation:{namespace}'
+
+def _create_tag_index(cursor):
+    duplicate = cursor.execute('SELECT tag FROM redactions GROUP BY tag HAVING COUNT(*) > 1 LIMIT 1').fetchone()
+    if duplicate is None:
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_redactions_tag ON redactions (tag)')
+    else:
+        logger.warning("[DB] Tag %s maps to several originals; indexing tags without UNIQUE", duplicate[0])
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_redactions_tag ON redactions (tag)')
+
+def _migrate_add_lookup_columns(cursor):
+    """
+    v1: normalized lookup key, entity type and creation time columns,
+    plus indexes for lookups by tag and by lookup key.
+    """
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(redactions)')}
+    for name in ('lookup_key', 'entity_type', 'created_at'):
+        if name not in columns:
+            cursor.execute(f'ALTER TABLE redactions ADD COLUMN {name} TEXT')
+    # SQLite's lower() only folds ASCII, so backfill keys from Python
+    rows = cursor.execute('SELECT rowid, original FROM redactions WHERE lookup_key IS NULL').fetchall()
+    cursor.executemany('UPDATE redactions SET lookup_key = ? WHERE rowid = ?',
+                       [(_lookup_key(original), rowid) for rowid, original in rows])
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_redactions_lookup_key ON redactions (lookup_key)')
+    _create_tag_index(cursor)
+
+def _migrate_add_namespaces(cursor):
+    """
+    v2: a namespace column in the primary key, so each project, matter or
+    tenant keeps its own vocabulary. Existing rows join the shared namespace.
+    """
+    # SQLite cannot change a primary key in place; rebuild the table
+    cursor.execute('''
+        CREATE TABLE redactions_v2
+        (namespace TEXT NOT NULL DEFAULT '', original TEXT NOT NULL, tag TEXT,
+         lookup_key TEXT, entity_type TEXT, created_at TEXT,
+         PRIMARY KEY (namespace, original))
+    ''')
+    cursor.execute('''
+        INSERT INTO redactions_v2 (namespace, original, tag, lookup_key, entity_type, created_at)
+        SELECT '', original, tag, lookup_key, entity_type, created_at FROM redactions ORDER BY rowid
+    ''')
+    cursor.execute('DROP TABLE redactions')
+    cursor.execute('ALTER TABLE redactions_v2 RENAME TO redactions')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_redactions_lookup_key ON redactions (namespace, lookup_key)')
+    _create_tag_index(cursor)
+
+# Applied in order by RedactionDatabase.create_table; never reorder or remove
+_MIGRATIONS = [
+    _migrate_add_lookup_columns,
+    _migrate_add_namespaces,
+]
 
 class RedactionDatabase:
-    def __init__(self):
-        print(f"[DB] Connecting to: {_DB_PATH}")
-        self.conn = sqlite3.connect(_DB_PATH)
+    """
+    Borrows a pooled connection for the lifetime of the object; close()
+    hands it back to the pool.
+    """
+    def __init__(self, pool=None):
+        self._pool = pool or get_pool()
+        # Time from asking for a connection to handing it back, reported as the "db" stage
+        self._started = time.perf_counter()
+        self.conn = self._pool.acquire()
         self.cursor = self.conn.cursor()
-        self.create_table()
 
     def create_table(self):
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS redactions
-            (original TEXT PRIMARY KEY, tag TEXT)
-        ''')
-        self.conn.commit()
+        """
+        Creates the schema, or upgrades an existing redactions.db in place.
+        PRAGMA user_version records how many of _MIGRATIONS have run.
+        """
+        # Take the write lock up front so concurrent processes migrate once
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS redactions
+                (original TEXT PRIMARY KEY, tag TEXT)
+            ''')
+            # Bumped on every write so in-memory caches can tell when to reload
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS redaction_meta
+                (name TEXT PRIMARY KEY, value INTEGER)
+            ''')
+            self.cursor.execute("INSERT OR IGNORE INTO redaction_meta (name, value) VALUES ('generation', 0)")
+            version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+            for target, migrate in enumerate(_MIGRATIONS, start=1):
+                if version < target:
+                    logger.info("[DB] Migrating schema to version %d", target)
+                    migrate(self.cursor)
+                    self.cursor.execute(f'PRAGMA user_version = {target}')
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
 
-    def add_redaction(self, original, tag):
-        self.cursor.execute('INSERT OR REPLACE INTO redactions (original, tag) VALUES (?, ?)', (original, tag))
-        self.conn.commit()
+    def add_redaction(self, original, tag, entity_type=None, namespace=SHARED_NAMESPACE):
+        self.add_redactions({original: tag}, {original: entity_type}, namespace)
 
-    def get_tag(self, original):
-        self.cursor.execute('SELECT tag FROM redactions WHERE original = ?', (original,))
+    def add_redactions(self, redaction_map, entity_types=None, namespace=SHARED_NAMESPACE):
+        """
+        Stores a whole original->tag map in a single transaction, in one
+        namespace. `entity_types` optionally maps originals to their entity label.
+        Re-tags originals already stored in the namespace.
+
+        Raises:
+            ValueError: A tag is already stored for a different original, in
+                this or another namespace, or the map gives it to several
+                originals. Nothing is stored.
+        """
+        items = list(redaction_map.items())
+        if not items:
+            return
+        entity_types = entity_types or {}
+        rows = [(namespace, original, tag, _lookup_key(original), entity_types.get(original)) for original, tag in items]
+        key = _generation_key(namespace)
+        # Take the write lock before checking tags so no other process can claim one in between
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self._check_tags_free(items, namespace)
+            self.cursor.executemany('''
+                INSERT INTO redactions (namespace, original, tag, lookup_key, entity_type, created_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(namespace, original) DO UPDATE SET
+                    tag = excluded.tag, lookup_key = excluded.lookup_key, entity_type = excluded.entity_type
+            ''', rows)
+            self.cursor.execute("INSERT OR IGNORE INTO redaction_meta (name, value) VALUES (?, 0)", (key,))
+            self.cursor.execute("UPDATE redaction_meta SET value = value + 1 WHERE name = ?", (key,))
+            generation = self.get_generation(namespace)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        _vocabularies.remember(namespace, items, generation)
+
+    def _taken_tags(self, tags):
+        """
+        Returns the subset of `tags` already stored, in any namespace.
+        """
+        taken = set()
+        for start in range(0, len(tags), _MAX_SQL_VARIABLES):
+            batch = tags[start:start + _MAX_SQL_VARIABLES]
+            placeholders = ','.join('?' * len(batch))
+            self.cursor.execute(f'SELECT tag FROM redactions WHERE tag IN ({placeholders})', batch)
+            taken.update(row[0] for row in self.cursor.fetchall())
+        return taken
+
+    def _check_tags_free(self, items, namespace):
+        """
+        Raises ValueError if any tag in `items` (original, tag) pairs is
+        stored for another row, or given to more than one original.
+        """
+        owners = {}
+        for original, tag in items:
+            if owners.setdefault(tag, original) != original:
+                raise ValueError(f"Tag {tag} is given to both {owners[tag]!r} and {original!r}.")
+        tags = list(owners)
+        step = _MAX_SQL_VARIABLES
+        for start in range(0, len(tags), step):
+            batch = tags[start:start + step]
+            placeholders = ','.join('?' * len(batch))
+            self.cursor.execute(f'SELECT namespace, original, tag FROM redactions WHERE tag IN ({placeholders})', batch)
+            for stored_namespace, original, tag in self.cursor.fetchall():
+                if stored_namespace != namespace or original != owners[tag]:
+                    raise ValueError(f"Tag {tag} is already in use for another redaction.")
+
+    def claim_redactions(self, redaction_map, entity_types=None, namespace=SHARED_NAMESPACE):
+        """
+        Stores newly minted original->tag mappings unless the original, or a
+        variant differing only in case, is already stored in the namespace,
+        e.g. by another process whose write this one has not seen yet.
+        Existing rows are never re-tagged, and a tag already stored for
+        another original is replaced with a freshly minted one.
+
+        Returns:
+            dict: original -> the tag now stored for it, for every original
+            in `redaction_map`.
+        """
+        items = list(redaction_map.items())
+        if not items:
+            return {}
+        entity_types = entity_types or {}
+        keys = list({_lookup_key(original) for original, _ in items})
+        key = _generation_key(namespace)
+        # Take the write lock before reading so no other process can insert in between
+        self.cursor.execute('BEGIN IMMEDIATE')
+        try:
+            stored = {}
+            stored_keys = {}
+            step = _MAX_SQL_VARIABLES - 1
+            for start in range(0, len(keys), step):
+                batch = keys[start:start + step]
+                placeholders = ','.join('?' * len(batch))
+                self.cursor.execute(f'SELECT original, tag, lookup_key FROM redactions WHERE namespace = ? '
+                                    f'AND lookup_key IN ({placeholders}) ORDER BY rowid', [namespace] + batch)
+                for original, tag, lookup_key in self.cursor.fetchall():
+                    stored[original] = tag
+                    stored_keys.setdefault(lookup_key, tag)
+            taken = self._taken_tags([tag for _, tag in items])
+            tags = {}
+            inserted = []
+            for original, tag in items:
+                existing = stored.get(original) or stored_keys.get(_lookup_key(original))
+                if existing is not None:
+                    tags[original] = existing
+                    continue
+                # A minted tag can collide with one stored for another original
+                while tag in taken:
+                    tag = _mint_tag()
+                    taken.update(self._taken_tags([tag]))
+                taken.add(tag)
+                self.cursor.execute('''
+                    INSERT INTO redactions (namespace, original, tag, lookup_key, entity_type, created_at)
+                    VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(namespace, original) DO NOTHING
+                ''', (namespace, original, tag, _lookup_key(original), entity_types.get(original)))
+                tags[original] = tag
+                inserted.append((original, tag))
+            generation = None
+            if inserted:
+                self.cursor.execute("INSERT OR IGNORE INTO redaction_meta (name, value) VALUES (?, 0)", (key,))
+                self.cursor.execute("UPDATE redaction_meta SET value = value + 1 WHERE name = ?", (key,))
+                generation = self.get_generation(namespace)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        if inserted:
+            _vocabularies.remember(namespace, inserted, generation)
+        if len(inserted) < len(items):
+            # Rows written elsewhere that the in-memory copy missed
+            _vocabularies.invalidate(namespace)
+        return tags
+
+    def get_generation(self, namespace=SHARED_NAMESPACE):
+        self.cursor.execute("SELECT value FROM redaction_meta WHERE name = ?", (_generation_key(namespace),))
         result = self.cursor.fetchone()
-        return result[0] if result else None
+        return result[0] if result else 0
 
-    def get_original(self, tag):
-        self.cursor.execute('SELECT original FROM redactions WHERE tag = ?', (tag,))
+    def get_tag(self, original, namespace=SHARED_NAMESPACE):
+        """
+        Returns the tag for an original, falling back to any stored variant
+        that differs only in case.
+        """
+        self.cursor.execute('SELECT tag FROM redactions WHERE namespace = ? AND original = ?', (namespace, original))
         result = self.cursor.fetchone()
+        if result is None:
+            self.cursor.execute('SELECT tag FROM redactions WHERE namespace = ? AND lookup_key = ? ORDER BY rowid LIMIT 1',
+                                (namespace, _lookup_key(original)))
+            result = self.cursor.fetchone()
         return result[0] if result else None
 
-    def get_all_redacted_items(self):
-        self.cursor.execute('SELECT original FROM redactions')
+    def get_original(self, tag, namespaces=(SHARED_NAMESPACE,)):
+        return self.get_originals([tag], namespaces).get(tag)
+
+    def get_originals(self, tags, namespaces=(SHARED_NAMESPACE,)):
+        """
+        Looks up many tags at once, only among the given namespaces. Returns
+        a dict of tag -> original for the tags that exist.
+        """
+        tags = list(tags)
+        namespaces = list(namespaces)
+        originals = {}
+        # Stay under SQLite's default limit on bound parameters
+        step = _MAX_SQL_VARIABLES - len(namespaces)
+        namespace_placeholders = ','.join('?' * len(namespaces))
+        for start in range(0, len(tags), step):
+            batch = tags[start:start + step]
+            placeholders = ','.join('?' * len(batch))
+            self.cursor.execute(f'SELECT tag, original FROM redactions WHERE tag IN ({placeholders}) '
+                                f'AND namespace IN ({namespace_placeholders})', batch + namespaces)
+            originals.update(self.cursor.fetchall())
+        return originals
+
+    def get_all_redacted_items(self, namespace=SHARED_NAMESPACE):
+        self.cursor.execute('SELECT original FROM redactions WHERE namespace = ?', (namespace,))
         return [row[0] for row in self.cursor.fetchall()]
 
+    def get_all_redactions(self, namespace=SHARED_NAMESPACE):
+        self.cursor.execute('SELECT original, tag FROM redactions WHERE namespace = ? ORDER BY rowid', (namespace,))
+        return self.cursor.fetchall()
+
     def close(self):
-        self.conn.close()
+        if self.conn is not None:
+            self._pool.release(self.conn)
+            self.conn = None
+            self.cursor = None
+            if metrics.METRICS_ENABLED:
+                metrics.observe_stage('db', time.perf_counter() - self._started)
+
+class RedactionVocabulary:
+    """
+    In-memory copy of one namespace of the redactions table.
+
+    Lookups and stored-redaction matching are served from memory. Writes
+    made through RedactionDatabase.add_redaction update the copy in place;
+    writes from other processes are picked up by comparing the namespace's
+    generation counter in the DB, at most once every VOCABULARY_CHECK_INTERVAL
+    seconds.
+    """
+    def __init__(self, namespace=SHARED_NAMESPACE, check_interval=VOCABULARY_CHECK_INTERVAL):
+        self.namespace = namespace
+        self.check_interval = check_interval
+        self._lock = threading.RLock()
+        self._load_lock = threading.Lock()
+        self._generation = None
+        self._checked_at = 0.0
+        self._tags = {}
+        self._keys = {}
+        self._originals = {}
+        # Bumped whenever the contents change, so combined matchers know to rebuild
+        self.version = 0
+        self._matchers = {}
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._generation is not None and now - self._checked_at < self.check_interval:
+            return
+        # The DB is read under a separate lock so writers calling remember()
+        # while holding a pooled connection never wait on a reader that is
+        # itself waiting for a connection.
+        with self._load_lock:
+            if self._generation is not None and now - self._checked_at < self.check_interval:
+                return
+            redaction_db = RedactionDatabase()
+            try:
+                generation = redaction_db.get_generation(self.namespace)
+                rows = None
+                if generation != self._generation:
+                    rows = redaction_db.get_all_redactions(self.namespace)
+            finally:
+                redaction_db.close()
+            with self._lock:
+                if rows is not None and (self._generation is None or self._generation < generation):
+                    self._tags = {original: tag for original, tag in rows}
+                    self._originals = {tag: original for original, tag in rows}
+                    self._keys = {}
+                    for original, tag in rows:
+                        self._keys.setdefault(_lookup_key(original), tag)
+                    self._changed()
+                    self._generation = generation
+                self._checked_at = time.monotonic()
+
+    def _changed(self):
+        self.version += 1
+        self._matchers = {}
+
+    def remember(self, items, generation):
+        """
+        Records (original, tag) rows this process has just written.
+        """
+        with self._lock:
+            if self._generation is None:
+                return
+            if generation != self._generation + 1:
+                # Another process wrote in between; reload on next access
+                self._generation = None
+                return
+            for original, tag in items:
+                previous = self._tags.get(original)
+                if previous is not None and self._originals.get(previous) == original:
+                    del self._originals[previous]
+                self._tags[original] = tag
+                self._originals[tag] = original
+                self._keys.setdefault(_lookup_key(original), tag)
+            self._changed()
+            self._generation = generation
+
+    def invalidate(self):
+        with self._lock:
+            self._generation = None
+
+    def get_tag(self, original):
+        self._refresh()
+        tag = self._tags.get(original)
+        if tag is None:
+            tag = self._keys.get(_lookup_key(original))
+        return tag
+
+    def get_original(self, tag):
+        self._refresh()
+        return self._originals.get(tag)
+
+    def stored_matcher(self, shared=None):
+        """
+        Returns a RedactionMatcher over every redaction stored in this
+        namespace, and also in the `shared` vocabulary if given. Built once
+        per change of either; this namespace's tags win where both hold an
+        entity.
+        """
+        self._refresh()
+        if shared is not None:
+            shared._refresh()
+        key = (self.version, shared.version) if shared is not None else (self.version,)
+        matcher = self._matchers.get(key)
+        if matcher is None:
+            with self._lock:
+                matcher = self._matchers.get(key)
+                if matcher is None:
+                    matcher = RedactionMatcher()
+                    sources = [self] if shared is None else [self, shared]
+                    for vocabulary in sources:
+                        with vocabulary._lock:
+                            for original, tag in vocabulary._tags.items():
+                                # Use the same pattern logic as manual redaction for consistency
+                                matcher.add(original, tag, manual=True)
+                    # Keep the newest own-only and combined matchers
+                    self._matchers = {k: m for k, m in self._matchers.items() if len(k) != len(key)}
+                    self._matchers[key] = matcher
+        return matcher
+
+class VocabularyRegistry:
+    """
+    One RedactionVocabulary per namespace, loaded on first use. The shared
+    namespace is always kept; other namespaces beyond `max_namespaces` are
+    dropped least recently used first and reloaded from the DB when next
+    needed. Matching one namespace never loads the others, so its cost
+    follows that namespace's size rather than the whole table's.
+    """
+    def __init__(self, max_namespaces=REDACTION_NAMESPACE_CACHE):
+        self.max_namespaces = max_namespaces
+        self._lock = threading.Lock()
+        self._shared = RedactionVocabulary(SHARED_NAMESPACE)
+        self._namespaces = OrderedDict()
+
+    def get(self, namespace=SHARED_NAMESPACE):
+        if namespace == SHARED_NAMESPACE:
+            return self._shared
+        with self._lock:
+            vocabulary = self._namespaces.get(namespace)
+            if vocabulary is None:
+                vocabulary = self._namespaces[namespace] = RedactionVocabulary(namespace)
+                while len(self._namespaces) > self.max_namespaces:
+                    self._namespaces.popitem(last=False)
+            else:
+                self._namespaces.move_to_end(namespace)
+            return vocabulary
+
+    def remember(self, namespace, items, generation):
+        if namespace == SHARED_NAMESPACE:
+            self._shared.remember(items, generation)
+            return
+        with self._lock:
+            vocabulary = self._namespaces.get(namespace)
+        # A namespace that isn't cached loads fresh when next used
+        if vocabulary is not None:
+            vocabulary.remember(items, generation)
+
+    def invalidate(self, namespace=None):
+        """
+        Forces a reload of one namespace, or of every cached one if None.
+        """
+        if namespace is not None:
+            self.get(namespace).invalidate()
+            return
+        with self._lock:
+            vocabularies = [self._shared, *self._namespaces.values()]
+        for vocabulary in vocabularies:
+            vocabulary.invalidate()
+
+    def stored_matcher(self, namespace=SHARED_NAMESPACE, include_shared=False):
+        """
+        Returns the matcher for a namespace's stored redactions, plus the
+        shared namespace's if `include_shared` is set.
+        """
+        vocabulary = self.get(namespace)
+        if include_shared and namespace != SHARED_NAMESPACE:
+            return vocabulary.stored_matcher(self._shared)
+        return vocabulary.stored_matcher()
+
+_vocabularies = VocabularyRegistry()
 
+_HTML_TAG_RE = re.compile('<[^<]+?>')
+_BLANK_LINES_RE = re.compile(r'\n\s*\n')
+
+@timed('clean_text')
 def clean_text(text):
     # Remove any HTML tags
-    text = re.sub('<[^<]+?>', '', text)
+    text = _HTML_TAG_RE.sub('', text)
     # Replace multiple newlines with a single newline
-    text = re.sub(r'\n\s*\n', '\n', text)
+    text = _BLANK_LINES_RE.sub('\n', text)
     # Remove leading/trailing whitespace
     text = text.strip()
     return text
 
-def redact_text(text, entities):
-    redacted_text = text
-    redaction_map = {}
-    redaction_db = RedactionDatabase()
+def iter_clean_text(pieces, max_tag_chars=STREAM_OVERLAP_CHARS):
+    """
+    Streaming clean_text(): yields the cleaned text of an iterable of text
+    pieces, holding back only what a later piece could still change (an
+    unclosed HTML tag and a trailing whitespace run).
 
-    for entity_type, entity_set in entities.items():
-        for entity in entity_set:
-            if entity not in redaction_map:
-                tag = redaction_db.get_tag(entity)
-                if not tag:
-                    tag = f"<ANON_{uuid.uuid4().hex[:8]}>"
-                    redaction_db.add_redaction(entity, tag)
-                redaction_map[entity] = tag
-            else:
-                tag = redaction_map[entity]
-
-            # Use precise pattern for manual selections (no word boundaries)
-            # Use word boundaries for pre-identified entities
-            if entity_type == 'MANUAL':
-                # Handle potential newlines in manual selections, similar to original PyQt app
-                pattern_text = re.escape(entity).replace(r'\n', r'\s*\n\s*')
-                pattern = re.compile(pattern_text, re.DOTALL | re.MULTILINE | re.IGNORECASE)
+    "".join() of the output equals clean_text("".join(pieces)), except that
+    an unclosed '<' more than `max_tag_chars` characters from its '>' is
+    kept as text.
+    """
+    tag_pending = ''
+    space_pending = ''
+    started = False
+
+    def clean(text, final):
+        nonlocal space_pending, started
+        # Collapsing a whitespace run again after it grows gives the same
+        # result as collapsing it once complete
+        text = _BLANK_LINES_RE.sub('\n', space_pending + text)
+        end = len(text.rstrip())
+        body = text[:end]
+        space_pending = '' if final else text[end:]
+        if not started:
+            body = body.lstrip()
+            started = bool(body)
+        return body
+
+    for piece in pieces:
+        text = tag_pending + piece
+        cut = len(text)
+        opening = text.rfind('<')
+        # A tag needs at least one character between '<' and '>'
+        if opening != -1 and text.find('>', opening + 2) == -1 and cut - opening <= max_tag_chars:
+            cut = opening
+        tag_pending = text[cut:]
+        body = clean(_HTML_TAG_RE.sub('', text[:cut]), final=False)
+        if body:
+            yield body
+    body = clean(_HTML_TAG_RE.sub('', tag_pending), final=True)
+    if body:
+        yield body
+
+def process_text(text, namespace=SHARED_NAMESPACE, include_shared=False):
+    """
+    Cleans text and applies the namespace's stored redactions to it.
+    """
+    return apply_stored_redactions(clean_text(text), namespace, include_shared)
+
+def iter_process_text(pieces, namespace=SHARED_NAMESPACE, include_shared=False):
+    """
+    Streaming process_text() for text too large to copy whole: cleans the
+    pieces and applies stored redactions window by window, in memory
+    proportional to the piece size.
+    """
+    return _vocabularies.stored_matcher(namespace, include_shared).iter_sub(iter_clean_text(pieces))
+
+# Regex fragments used as trie atoms by RedactionMatcher.
+# Detected entities share trie branches with manual selections, so their
+# leading boundary is captured once up front and checked where they end.
+_START_BOUNDARY = r'(\b)'
+_END_BOUNDARY = r'(?(1)\b|(?!))'
+_NEWLINE_RUN = r'\s*\n\s*'
+_NEWLINE_KEY_RE = re.compile(r'\s*\n\s*')
+
+def _entity_pattern(entity, manual):
+    """
+    Builds the standalone regex for a single entity. Manual selections
+    tolerate whitespace around newlines; detected entities need word boundaries.
+    """
+    if manual:
+        pattern_text = _NEWLINE_RUN.join(re.escape(part) for part in entity.split('\n'))
+    else:
+        pattern_text = r'\b' + re.escape(entity) + r'\b'
+    return re.compile(pattern_text, re.IGNORECASE)
+
+class RedactionMatcher:
+    """
+    Replaces many entities with their tags in a single scan of the text.
+
+    Entities are folded into a character trie which is compiled to one
+    regex, so matching cost no longer grows with the number of entities
+    times the document length. Overlapping matches resolve leftmost first,
+    then longest; entities that share a normalized form use the first tag added.
+    """
+    def __init__(self):
+        self._trie = {}
+        self._tags = {}
+        self._entries = []
+        self._longest = 0
+        self._manual = 0
+        self._regex = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _key(text):
+        return _NEWLINE_KEY_RE.sub('\n', text.lower())
+
+    @staticmethod
+    def _atom(char):
+        lowered = char.lower()
+        return re.escape(lowered if len(lowered) == 1 else char)
+
+    def add(self, entity, tag, manual=False):
+        """
+        Registers an entity. Manual selections match across reflowed
+        newlines; other entities must sit on word boundaries.
+        """
+        if not entity:
+            return
+        self._entries.append((entity, tag, manual))
+        self._tags.setdefault(self._key(entity), tag)
+        self._longest = max(self._longest, len(entity))
+
+        self._manual += manual
+
+        node = self._trie
+        for char in entity:
+            atom = _NEWLINE_RUN if manual and char == '\n' else self._atom(char)
+            node = node.setdefault(atom, {})
+        if not manual:
+            node = node.setdefault(_END_BOUNDARY, {})
+        node[''] = True
+        self._regex = None
+
+    @classmethod
+    def _emit(cls, node):
+        # Unbranched runs are emitted inline so the regex nesting depth
+        # follows the number of branch points, not the entity length.
+        parts = []
+        while True:
+            terminal = '' in node
+            children = [(atom, child) for atom, child in node.items() if atom != '']
+            if not children:
+                return ''.join(parts)
+            if len(children) == 1 and not terminal:
+                atom, node = children[0]
+                parts.append(atom)
+                continue
+            # Consuming atoms go before the zero-width boundary so longer
+            # entities are preferred over shorter ones sharing a prefix.
+            children.sort(key=lambda item: item[0] == _END_BOUNDARY)
+            alternatives = '|'.join(atom + cls._emit(child) for atom, child in children)
+            parts.append('(?:' + alternatives + ')' + ('?' if terminal else ''))
+            return ''.join(parts)
+
+    def _compile(self):
+        if self._regex is None:
+            if self._manual == len(self._entries):
+                prefix = ''
+            elif self._manual:
+                # Where there is no boundary only manual selections can match
+                prefix = _START_BOUNDARY + '?'
             else:
-                pattern_text = r'\b' + re.escape(entity) + r'\b'
-                pattern = re.compile(pattern_text, re.IGNORECASE)
+                prefix = _START_BOUNDARY
+            self._regex = re.compile(prefix + self._emit(self._trie), re.IGNORECASE)
+        return self._regex
+
+    def _tag_for(self, matched):
+        tag = self._tags.get(self._key(matched))
+        if tag is not None:
+            return tag
+        # Case folding rules in `re` differ from str.lower() for a handful
+        # of characters; fall back to checking each entity individually.
+        for entity, tag, manual in self._entries:
+            if _entity_pattern(entity, manual).fullmatch(matched):
+                return tag
+        return matched
+
+    def sub(self, text):
+        """
+        Returns the text with every registered entity replaced by its tag.
+        """
+        if not self._entries:
+            return text
+        return self._compile().sub(lambda m: self._tag_for(m.group(0)), text)
+
+    def iter_sub(self, pieces, overlap=STREAM_OVERLAP_CHARS):
+        """
+        Streaming sub(): yields the redacted text of an iterable of text
+        pieces. The last `overlap` characters of each window are scanned
+        again with the next piece, so matches across piece boundaries are
+        found. The overlap is widened to fit the longest entity; only
+        whitespace runs inside a multi-line match longer than that can be
+        missed at a boundary.
+        """
+        if not self._entries:
+            yield from pieces
+            return
+        regex = self._compile()
+        overlap = max(overlap, 2 * self._longest + 2)
+        buffer = ''
+        # Where scanning resumes; the character before it is kept for \b
+        start = 0
+        for piece in pieces:
+            buffer += piece
+            # Matches starting before `cut` cannot reach past the buffer
+            cut = len(buffer) - overlap
+            if cut <= start:
+                continue
+            out, keep = self._sub_window(regex, buffer, start, cut)
+            yield out
+            buffer = buffer[keep - 1:]
+            start = 1
+        if len(buffer) > start:
+            yield self._sub_window(regex, buffer, start, len(buffer))[0]
 
-            redacted_text = pattern.sub(tag, redacted_text)
+    def _sub_window(self, regex, buffer, start, cut):
+        # Replaces matches in buffer[start:] that start before `cut`. Returns
+        # the text up to the end of the last one (or `cut`) and that position.
+        out = []
+        position = start
+        for match in regex.finditer(buffer, start):
+            if match.start() >= cut:
+                break
+            if match.end() > match.start():
+                out.append(buffer[position:match.start()])
+                out.append(self._tag_for(match.group(0)))
+                position = match.end()
+        keep = max(position, cut)
+        out.append(buffer[position:keep])
+        return "".join(out), keep
 
-    redaction_db.close()
-    return redacted_text, redaction_map
+    def spans(self, text):
+        """
+        Yields (start, end, tag) for every match in the text, left to right,
+        without building the redacted text.
+        """
+        if not self._entries:
+            return
+        tags = {}
+        for match in self._compile().finditer(text):
+            start, end = match.span()
+            if end > start:
+                matched = match.group(0)
+                tag = tags.get(matched)
+                if tag is None:
+                    tag = tags[matched] = self._tag_for(matched)
+                yield start, end, tag
 
-def apply_redaction(text, redaction_map):
+_tag_lock = threading.Lock()
+
+def build_redaction_matcher(entities, namespace=SHARED_NAMESPACE, include_shared=False):
     """
-    Apply redaction to the text using the provided redaction map.
+    Assigns a tag to every entity, storing the new ones, and returns a
+    matcher that replaces them.
+
+    Args:
+        entities (dict): Entity type -> iterable of entity strings. Entities
+            of type MANUAL are matched like manual selections.
+        namespace (str): Namespace whose tags are reused and where new ones
+            are stored.
+        include_shared (bool): Also reuse tags from the shared namespace.
+
+    Returns:
+        tuple: (RedactionMatcher, redaction_map of entity -> tag)
     """
-    redacted_text = text
-    redaction_db = RedactionDatabase()
+    redaction_map = {}
+    new_redactions = {}
+    new_entity_types = {}
+    new_keys = {}
+    selections = []
+    matcher = RedactionMatcher()
+    vocabulary = _vocabularies.get(namespace)
+    shared = _vocabularies.get(SHARED_NAMESPACE) if include_shared and namespace != SHARED_NAMESPACE else None
+
+    # Concurrent callers must not both mint a tag for the same new entity;
+    # across processes, claim_redactions keeps whichever tag was stored first
+    with _tag_lock:
+        for entity_type, entity_set in entities.items():
+            for entity in entity_set:
+                if entity not in redaction_map:
+                    # Case variants of a known entity reuse its tag instead of
+                    # adding another row
+                    tag = (vocabulary.get_tag(entity) or (shared and shared.get_tag(entity))
+                           or new_keys.get(_lookup_key(entity)))
+                    if not tag:
+                        tag = _mint_tag()
+                        new_redactions[entity] = tag
+                        new_entity_types[entity] = entity_type
+                        new_keys[_lookup_key(entity)] = tag
+                    redaction_map[entity] = tag
+                selections.append((entity, entity_type == 'MANUAL'))
+
+        if new_redactions:
+            redaction_db = RedactionDatabase()
+            try:
+                stored = redaction_db.claim_redactions(new_redactions, new_entity_types, namespace)
+            finally:
+                redaction_db.close()
+            # Another process may have stored some of these first; use its tags
+            replaced = {tag: stored[original] for original, tag in new_redactions.items() if stored[original] != tag}
+            if replaced:
+                redaction_map = {entity: replaced.get(tag, tag) for entity, tag in redaction_map.items()}
+
+    for entity, manual in selections:
+        # Use precise pattern for manual selections (no word boundaries)
+        # Use word boundaries for pre-identified entities
+        matcher.add(entity, redaction_map[entity], manual=manual)
+    return matcher, redaction_map
+
+@timed('redact_text')
+def redact_text(text, entities, namespace=SHARED_NAMESPACE, include_shared=False):
+    matcher, redaction_map = build_redaction_matcher(entities, namespace, include_shared)
+    return matcher.sub(text), redaction_map
+
+def apply_redaction(text, redaction_map, namespace=SHARED_NAMESPACE):
+    """
+    Apply redaction to the text using the provided redaction map, storing
+    the map in the namespace.
+    """
+    matcher = RedactionMatcher()
     for original, tag in redaction_map.items():
-        redaction_db.add_redaction(original, tag)
-        pattern = r'\b' + re.escape(original) + r'\b'
-        redacted_text = re.sub(pattern, tag, redacted_text, flags=re.IGNORECASE)
-    redaction_db.close()
-    return redacted_text
+        matcher.add(original, tag)
+    redaction_db = RedactionDatabase()
+    try:
+        redaction_db.add_redactions(redaction_map, namespace=namespace)
+    finally:
+        redaction_db.close()
+    return matcher.sub(text)
 
 def unredact_text(redacted_text, redaction_map):
     """
     Reverse the redaction process using the redaction map.
     """
-    unredacted_text = redacted_text
+    originals = {}
     for original, tag in redaction_map.items():
-        unredacted_text = unredacted_text.replace(tag, original)
-    return unredacted_text
+        if tag:
+            originals.setdefault(tag, original)
+    if not originals:
+        return redacted_text
+    # Longest tags first so a tag that prefixes another can't shadow it
+    pattern = re.compile('|'.join(re.escape(tag) for tag in sorted(originals, key=len, reverse=True)))
+    return pattern.sub(lambda m: originals[m.group(0)], redacted_text)
 
-def apply_stored_redactions(text):
+@timed('apply_stored_redactions')
+def apply_stored_redactions(text, namespace=SHARED_NAMESPACE, include_shared=False):
     """
-    Applies all previously stored redactions from the database to the text.
+    Applies the redactions previously stored in a namespace to the text,
+    plus the shared namespace's if `include_shared` is set.
     """
-    redaction_db = RedactionDatabase()
-    redacted_text = text
-    try:
-        all_originals = redaction_db.get_all_redacted_items()
-        for original in all_originals:
-            tag = redaction_db.get_tag(original)
-            if tag:
-                # Use the same pattern logic as manual redaction for consistency
-                pattern_text = re.escape(original).replace(r'\n', r'\s*\n\s*')
-                pattern = re.compile(pattern_text, re.DOTALL | re.MULTILINE | re.IGNORECASE)
-                redacted_text = pattern.sub(tag, redacted_text)
-    finally:
-        redaction_db.close()
-    return redacted_text
+    return _vocabularies.stored_matcher(namespace, include_shared).sub(text)
+
+_ANON_TAG_RE = re.compile(r'<ANON_[a-f0-9]{8}>')
 
-def deanonymize_using_db(text):
+@timed('deanonymize')
+def deanonymize_using_db(text, verbose=False, namespace=SHARED_NAMESPACE, include_shared=False):
     """
     Replaces all known <ANON_*> tags found in the text with their
     original values looked up from the database.
+
+    Only tags stored in `namespace` (and the shared namespace, if
+    `include_shared` is set) are resolved; others are left as they are.
+    Tags are resolved from the in-memory vocabulary; any it doesn't know
+    yet are fetched with one batched query. Set `verbose` to log each lookup.
     """
-    redaction_db = RedactionDatabase()
-    deanonymized_text = text
-    try:
-        # Find all potential ANON tags in the input text
-        anon_tags = re.findall(r'<ANON_[a-f0-9]{8}>', text)
-        found_tags = set(anon_tags)
-        print(f"[Deanonymize] Found tags in input: {found_tags if found_tags else 'None'}")
+    found_tags = set(_ANON_TAG_RE.findall(text))
+    if verbose:
+        logger.info("[Deanonymize] Found tags in input: %s", found_tags if found_tags else 'None')
+    if not found_tags:
+        return text
+
+    namespaces = [namespace]
+    if include_shared and namespace != SHARED_NAMESPACE:
+        namespaces.append(SHARED_NAMESPACE)
+    vocabularies = [_vocabularies.get(name) for name in namespaces]
+    originals = {}
+    missing = []
+    for tag in found_tags:
+        original = next(filter(None, (vocabulary.get_original(tag) for vocabulary in vocabularies)), None)
+        if original:
+            originals[tag] = original
+        else:
+            missing.append(tag)
+    if missing:
+        redaction_db = RedactionDatabase()
+        try:
+            originals.update(redaction_db.get_originals(missing, namespaces))
+        finally:
+            redaction_db.close()
 
+    if verbose:
         for tag in found_tags:
-            original = redaction_db.get_original(tag)
-            if original:
-                print(f"[Deanonymize] Found original for {tag}: '{original[:50]}...'")
-                # Replace all instances of this specific tag
-                deanonymized_text = deanonymized_text.replace(tag, original)
+            if originals.get(tag):
+                logger.info("[Deanonymize] Found original for %s: '%s...'", tag, originals[tag][:50])
             else:
-                print(f"[Deanonymize] No original found in DB for tag: {tag}")
-    finally:
-        redaction_db.close()
-    return deanonymized_text
\ No newline at end of file
+                logger.info("[Deanonymize] No original found in DB for tag: %s", tag)
+
+    def _replace(match):
+        return originals.get(match.group(0)) or match.group(0)
+
+    return _ANON_TAG_RE.sub(_replace, text)
@@ -0,0 +1,145 @@
+# retrieval.py
+# Local BM25 index over a document's chunks. Follow-up questions send the
+# chunks most relevant to the question instead of the whole document; all
+# scoring happens in-process with NumPy, no network or outside service.
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import split_into_chunks
+
+# Characters per indexed chunk
+RETRIEVAL_CHUNK_CHARS = int(os.environ.get('RETRIEVAL_CHUNK_CHARS', '1200'))
+# Chunks sent with each follow-up question
+RETRIEVAL_TOP_K = int(os.environ.get('RETRIEVAL_TOP_K', '6'))
+# Documents shorter than this are still sent whole
+RETRIEVAL_MIN_CHARS = int(os.environ.get('RETRIEVAL_MIN_CHARS', '20000'))
+# Document indexes kept in memory
+RETRIEVAL_MAX_DOCUMENTS = int(os.environ.get('RETRIEVAL_MAX_DOCUMENTS', '32'))
+
+# Standard BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text.lower())
+
+def document_id(text):
+    """
+    Returns the content address of a document, used to look up its index.
+    """
+    return hashlib.sha256(text.encode('utf-8', 'surrogatepass')).hexdigest()
+
+class DocumentIndex:
+    """
+    BM25 index of one document's chunks.
+
+    Postings are stored term by term in flat NumPy arrays (a sparse
+    term-chunk matrix in CSC layout) with the BM25 weight of each term in
+    each chunk precomputed, so scoring a question is one array addition per
+    question term.
+    """
+    def __init__(self, text, chunk_chars=None):
+        chunk_chars = chunk_chars or RETRIEVAL_CHUNK_CHARS
+        self.chunks = [chunk for _, chunk in split_into_chunks(text, chunk_chars)]
+        self.vocabulary = {}
+
+        chunk_ids = []
+        term_ids = []
+        for chunk_id, chunk in enumerate(self.chunks):
+            for token in tokenize(chunk):
+                term_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                chunk_ids.append(chunk_id)
+
+        chunk_count = max(len(self.chunks), 1)
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+
+        # Count each (term, chunk) pair; np.unique sorts by term, then chunk
+        pairs, term_freq = np.unique(term_ids * chunk_count + chunk_ids, return_counts=True)
+        posting_terms = pairs // chunk_count
+        self.posting_chunks = (pairs % chunk_count).astype(np.int32)
+
+        chunk_lengths = np.bincount(chunk_ids, minlength=chunk_count).astype(np.float32)
+        average_length = max(float(chunk_lengths.mean()), 1.0)
+        doc_freq = np.bincount(posting_terms, minlength=len(self.vocabulary))
+        idf = np.log1p((chunk_count - doc_freq + 0.5) / (doc_freq + 0.5))
+
+        length_norm = BM25_K1 * (1 - BM25_B + BM25_B * chunk_lengths[self.posting_chunks] / average_length)
+        self.posting_weights = (idf[posting_terms] * term_freq * (BM25_K1 + 1) / (term_freq + length_norm)).astype(np.float32)
+        self.term_offsets = np.concatenate(([0], np.cumsum(doc_freq))).astype(np.int64)
+
+    def search(self, query, k=None):
+        """
+        Returns the `k` chunks that best match `query`, in document order.
+        When no query term occurs in the document, the leading chunks are
+        returned instead.
+
+        Returns:
+            list: (chunk_index, chunk) tuples.
+        """
+        k = k or RETRIEVAL_TOP_K
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term)
+            if term_id is None:
+                continue
+            start, end = self.term_offsets[term_id], self.term_offsets[term_id + 1]
+            scores[self.posting_chunks[start:end]] += self.posting_weights[start:end]
+
+        matching = np.flatnonzero(scores > 0)
+        if len(matching) == 0:
+            best = range(min(k, len(self.chunks)))
+        else:
+            best = sorted(matching[np.argsort(-scores[matching], kind='stable')[:k]].tolist())
+        return [(index, self.chunks[index]) for index in best]
+
+class RetrievalIndexStore:
+    """
+    LRU of document indexes keyed by document_id().
+    """
+    def __init__(self, max_documents=RETRIEVAL_MAX_DOCUMENTS):
+        self.max_documents = max_documents
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, doc_id):
+        with self._lock:
+            index = self._indexes.get(doc_id)
+            if index is not None:
+                self._indexes.move_to_end(doc_id)
+            return index
+
+    def get_or_build(self, text):
+        """
+        Returns (doc_id, index) for `text`, building the index if it is not
+        already cached. CPU-bound; run it in the executor.
+        """
+        doc_id = document_id(text)
+        index = self.get(doc_id)
+        if index is None:
+            index = DocumentIndex(text)
+            with self._lock:
+                self._indexes[doc_id] = index
+                while len(self._indexes) > self.max_documents:
+                    self._indexes.popitem(last=False)
+        return doc_id, index
+
+    def discard(self, doc_id):
+        with self._lock:
+            self._indexes.pop(doc_id, None)
+
+    def stats(self):
+        return {
+            'documents': len(self._indexes),
+            'max_documents': self.max_documents,
+            'chunks': sum(len(index.chunks) for index in list(self._indexes.values())),
+        }
+
+retrieval_indexes = RetrievalIndexStore()
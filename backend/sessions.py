@@ -0,0 +1,210 @@
+# sessions.py
+# Server-side follow-up conversations. The client sends only a session_id and
+# the new question; the server keeps the document and the history, and folds
+# older turns into a running summary once the history outgrows its budget.
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from map_reduce import estimate_tokens
+
+# Sessions kept in memory
+SESSION_MAX = int(os.environ.get('SESSION_MAX', '256'))
+# Seconds of inactivity after which a session is dropped
+SESSION_TTL = float(os.environ.get('SESSION_TTL', '86400'))
+# Optional SQLite file that keeps sessions across restarts; empty disables it
+SESSION_STORE_DB = os.environ.get('SESSION_STORE_DB', '')
+# Estimated tokens of verbatim history before older turns are compacted
+SESSION_HISTORY_TOKENS = int(os.environ.get('SESSION_HISTORY_TOKENS', '3000'))
+# Most recent messages that always stay verbatim after compaction
+SESSION_KEEP_MESSAGES = int(os.environ.get('SESSION_KEEP_MESSAGES', '4'))
+# Max tokens for the running summary of compacted turns
+SESSION_SUMMARY_MAX_TOKENS = int(os.environ.get('SESSION_SUMMARY_MAX_TOKENS', '400'))
+
+COMPACTION_PROMPT_TEMPLATE = """
+    Below is the summary of an earlier part of a conversation about a document, followed by
+    the turns that came after it. Write an updated summary of the whole conversation so far
+    that keeps every question asked, the facts given in the answers, and anything the user
+    asked to remember. Be concise; bullet points are fine.
+
+    **SUMMARY SO FAR:**
+    {summary}
+
+    **LATER TURNS:**
+    {turns}
+    """
+
+class Session:
+    """
+    One follow-up conversation: the document it is about, a running summary
+    of compacted turns and the recent messages kept verbatim.
+    """
+    def __init__(self, session_id, document="", summary="", messages=None, updated_at=None):
+        self.session_id = session_id
+        self.document = document
+        self.summary = summary
+        self.messages = messages or []
+        self.updated_at = updated_at or time.time()
+        self.compacting = False
+
+    def add_turn(self, question, answer):
+        self.messages.append({"role": "user", "content": question})
+        self.messages.append({"role": "assistant", "content": answer})
+        self.updated_at = time.time()
+
+    def history_tokens(self):
+        return sum(estimate_tokens(message['content']) for message in self.messages)
+
+    def needs_compaction(self, budget=None, keep=None):
+        budget = SESSION_HISTORY_TOKENS if budget is None else budget
+        keep = SESSION_KEEP_MESSAGES if keep is None else keep
+        return len(self.messages) > keep and self.history_tokens() > budget
+
+    def to_dict(self):
+        return {
+            'session_id': self.session_id,
+            'document': self.document,
+            'summary': self.summary,
+            'messages': self.messages,
+            'updated_at': self.updated_at,
+        }
+
+async def compact_session(session, complete, keep=None):
+    """
+    Folds all but the last `keep` messages into the session's running summary.
+
+    Args:
+        session (Session): The session to compact in place.
+        complete: Async callable taking (prompt, max_tokens) and returning
+            the provider's response text.
+        keep (int): Messages left verbatim. Defaults to SESSION_KEEP_MESSAGES.
+
+    Returns:
+        bool: True if the session was compacted.
+    """
+    keep = SESSION_KEEP_MESSAGES if keep is None else keep
+    if session.compacting or len(session.messages) <= keep:
+        return False
+    session.compacting = True
+    try:
+        # New turns may be appended while the summary is generated; only the
+        # messages summarized here are dropped afterwards
+        cut = len(session.messages) - keep
+        turns = "\n\n".join(f"{message['role'].capitalize()}: {message['content']}" for message in session.messages[:cut])
+        prompt = COMPACTION_PROMPT_TEMPLATE.format(summary=session.summary or "None", turns=turns)
+        session.summary = (await complete(prompt, SESSION_SUMMARY_MAX_TOKENS)).strip()
+        session.messages = session.messages[cut:]
+        return True
+    finally:
+        session.compacting = False
+
+class SessionStore:
+    """
+    Size-bounded LRU of sessions with an optional SQLite tier, written
+    through on every save, that survives restarts.
+    """
+    def __init__(self, max_sessions=SESSION_MAX, ttl=SESSION_TTL, db_path=SESSION_STORE_DB):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.db_path = db_path
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _disk(self):
+        if not self.db_path:
+            return None
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS sessions
+                (session_id TEXT PRIMARY KEY, data TEXT, updated_at REAL)
+            ''')
+            self._conn.commit()
+        return self._conn
+
+    def _remember(self, session):
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _expired(self, updated_at):
+        return self.ttl > 0 and updated_at + self.ttl < time.time()
+
+    def create(self, document=""):
+        session = Session(uuid.uuid4().hex, document=document)
+        self.save(session)
+        return session
+
+    def get(self, session_id):
+        """
+        Returns the session with this id, or None if it is unknown or expired.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                conn = self._disk()
+                if conn is not None:
+                    row = conn.execute('SELECT data FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+                    if row is not None:
+                        session = Session(**json.loads(row[0]))
+            if session is None:
+                return None
+            if self._expired(session.updated_at):
+                self._delete(session_id)
+                return None
+            self._remember(session)
+            return session
+
+    def save(self, session):
+        with self._lock:
+            self._remember(session)
+            conn = self._disk()
+            if conn is not None:
+                conn.execute(
+                    'INSERT OR REPLACE INTO sessions (session_id, data, updated_at) VALUES (?, ?, ?)',
+                    (session.session_id, json.dumps(session.to_dict()), session.updated_at)
+                )
+                conn.commit()
+
+    def _delete(self, session_id):
+        self._sessions.pop(session_id, None)
+        conn = self._disk()
+        if conn is not None:
+            conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            conn.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._delete(session_id)
+
+    def purge_expired(self):
+        """
+        Drops sessions idle for longer than the TTL.
+        """
+        if self.ttl <= 0:
+            return
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            for session_id in [key for key, session in self._sessions.items() if session.updated_at < cutoff]:
+                del self._sessions[session_id]
+            conn = self._disk()
+            if conn is not None:
+                conn.execute('DELETE FROM sessions WHERE updated_at < ?', (cutoff,))
+                conn.commit()
+
+    def stats(self):
+        return {
+            'sessions': len(self._sessions),
+            'max_sessions': self.max_sessions,
+            'ttl': self.ttl,
+            'disk_tier': bool(self.db_path),
+        }
+
+session_store = SessionStore()
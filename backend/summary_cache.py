@@ -0,0 +1,81 @@
+# summary_cache.py
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Maximum number of summaries kept in memory
+SUMMARY_CACHE_SIZE = int(os.environ.get('SUMMARY_CACHE_SIZE', '128'))
+# Seconds a cached summary stays valid; 0 disables the cache
+SUMMARY_CACHE_TTL = float(os.environ.get('SUMMARY_CACHE_TTL', '3600'))
+
+def make_summary_key(model_id, prompt_version, text):
+    """
+    Builds the cache key for a summary of `text` produced by `model_id`
+    with a given version of the summary prompt.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{model_id}\0{prompt_version}\0".encode('utf-8'))
+    digest.update(text.encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+class SummaryCache:
+    """
+    LRU of completed summaries whose entries expire after `ttl` seconds.
+    """
+    def __init__(self, max_entries=SUMMARY_CACHE_SIZE, ttl=SUMMARY_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if self.ttl <= 0:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, summary = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return summary
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, summary):
+        if self.ttl <= 0 or not summary:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, summary)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'max_entries': self.max_entries,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+def replay_chunks(summary, size=64):
+    """
+    Splits a cached summary into chunks for replaying over SSE, breaking
+    after whitespace so words are not cut in half.
+    """
+    start = 0
+    while start < len(summary):
+        end = min(start + size, len(summary))
+        if end < len(summary):
+            cut = summary.rfind(' ', start, end)
+            if cut > start:
+                end = cut + 1
+        yield summary[start:end]
+        start = end
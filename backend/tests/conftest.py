@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import redactor
+
+
+@pytest.fixture
+def redaction_db(tmp_path, monkeypatch):
+    """Points the redactor at an empty database with cold in-memory caches."""
+    monkeypatch.setattr(redactor, '_DB_PATH', str(tmp_path / 'redactions.db'))
+    monkeypatch.setattr(redactor, '_vocabularies', redactor.VocabularyRegistry())
+    yield redactor
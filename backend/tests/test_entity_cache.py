@@ -0,0 +1,30 @@
+import os
+import signal
+
+import pytest
+
+from entity_cache import EntityCache
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs os.fork")
+def test_forked_child_opens_its_own_connection(tmp_path):
+    cache = EntityCache(db_path=str(tmp_path / 'entities.db'))
+    cache.put('key', {'PERSON': {'Alice'}})
+    parent_conn = cache._conn
+    cache._lock.acquire()
+    pid = os.fork()
+    if pid == 0:
+        ok = False
+        # Fail rather than hang if the inherited lock is still held
+        signal.alarm(10)
+        try:
+            # The lock held at fork time is replaced, and a fresh connection
+            # reads the parent's row from disk
+            cache._entries.clear()
+            ok = cache.get('key') == {'PERSON': {'Alice'}} and cache._conn is not parent_conn
+        finally:
+            os._exit(0 if ok else 1)
+    cache._lock.release()
+    _, status = os.waitpid(pid, 0)
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+    assert cache.get('key') == {'PERSON': {'Alice'}}
@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+spacy = pytest.importorskip('spacy')
+
+import utils
+
+PATTERNS = [
+    {'label': 'PERSON', 'pattern': [{'LOWER': 'jane'}, {'LOWER': 'doe'}]},
+    {'label': 'PERSON', 'pattern': [{'LOWER': 'mary'}, {'LOWER': 'ann'}, {'LOWER': 'smith'}]},
+    {'label': 'ORG', 'pattern': [{'LOWER': 'acme'}, {'LOWER': 'widget'}, {'LOWER': 'corp'}]},
+    {'label': 'GPE', 'pattern': [{'LOWER': 'new'}, {'LOWER': 'york'}]},
+    # Fragments of the names above, only seen when a name is cut in two
+    {'label': 'GPE', 'pattern': [{'LOWER': 'doe'}]},
+    {'label': 'ORG', 'pattern': [{'LOWER': 'widget'}, {'LOWER': 'corp'}]},
+]
+WORDS = ['the', 'report', 'from', 'met', 'with', 'in', 'Jane Doe', 'Mary Ann Smith',
+         'Acme Widget Corp', 'New York', 'said', 'and', 'about']
+
+
+@pytest.fixture
+def nlp(monkeypatch):
+    model = spacy.blank('en')
+    model.add_pipe('entity_ruler').add_patterns(PATTERNS)
+    monkeypatch.setattr(utils.nlp_models, 'get', lambda language: model)
+    return model
+
+
+@pytest.mark.parametrize('chunk_size', [15, 23, 40])
+def test_chunked_entities_match_unchunked(nlp, monkeypatch, chunk_size):
+    rng = random.Random(chunk_size)
+    for _ in range(50):
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(5, 40)))
+        monkeypatch.setattr(utils, 'NER_CHUNK_SIZE', 10 ** 6)
+        expected = utils._extract_entities(text, 'en')
+        monkeypatch.setattr(utils, 'NER_CHUNK_SIZE', chunk_size)
+        assert utils._extract_entities(text, 'en') == expected, text
+
+
+def test_name_straddling_chunks_is_found_once(nlp, monkeypatch):
+    monkeypatch.setattr(utils, 'NER_CHUNK_SIZE', 20)
+    text = "We spoke to Jane Doe about it."
+    assert [chunk for _, chunk in utils.split_into_chunks(text)][0].endswith("Jane ")
+    assert utils._extract_entities(text, 'en') == {'PERSON': {'Jane Doe'}, 'GPE': set(), 'ORG': set()}
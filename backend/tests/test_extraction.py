@@ -0,0 +1,51 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+fitz = pytest.importorskip('fitz')
+
+import extraction
+
+
+def make_pdf(page_count):
+    doc = fitz.open()
+    for number in range(1, page_count + 1):
+        doc.new_page().insert_text((72, 72), f"Page {number}")
+    try:
+        return doc.tobytes()
+    finally:
+        doc.close()
+
+
+class CountingPool:
+    """Thread pool that records how many tasks ran at once."""
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=8)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def _run(self, fn, *args):
+        with self._lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def submit(self, fn, *args):
+        return self._pool.submit(self._run, fn, *args)
+
+
+def test_parallel_extraction_is_ordered_and_bounded_by_workers(monkeypatch):
+    pool = CountingPool()
+    monkeypatch.setattr(extraction, 'get_extraction_pool', lambda: pool)
+    data = make_pdf(40)
+    serial = list(extraction.iter_pdf_pages(data, workers=1))
+    parallel = list(extraction.iter_pdf_pages(data, workers=2, min_pages=1))
+    assert parallel == serial
+    assert [number for number, _, _ in parallel] == list(range(1, 41))
+    assert 1 <= pool.peak <= 2
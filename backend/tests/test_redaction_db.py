@@ -0,0 +1,57 @@
+import pytest
+
+
+def test_tag_in_two_namespaces_keeps_both_rows(redaction_db):
+    db = redaction_db.RedactionDatabase()
+    try:
+        db.create_table()
+        db.add_redactions({'Alice': '<ANON_0000000a>'}, namespace='matter-1')
+        with pytest.raises(ValueError):
+            db.add_redactions({'Bob': '<ANON_0000000a>'}, namespace='matter-2')
+        assert db.get_all_redactions('matter-1') == [('Alice', '<ANON_0000000a>')]
+        assert db.get_all_redactions('matter-2') == []
+        assert db.get_original('<ANON_0000000a>', ['matter-1']) == 'Alice'
+    finally:
+        db.close()
+
+
+def test_add_redactions_retags_within_namespace(redaction_db):
+    db = redaction_db.RedactionDatabase()
+    try:
+        db.create_table()
+        db.add_redactions({'Alice': '<ANON_0000000a>', 'Bob': '<ANON_0000000b>'}, namespace='matter-1')
+        db.add_redactions({'Alice': '<ANON_0000000c>'}, namespace='matter-1')
+        assert dict(db.get_all_redactions('matter-1')) == {'Alice': '<ANON_0000000c>', 'Bob': '<ANON_0000000b>'}
+        with pytest.raises(ValueError):
+            db.add_redactions({'Carol': '<ANON_0000000b>'}, namespace='matter-1')
+    finally:
+        db.close()
+
+
+def test_claim_redactions_remints_colliding_tag(redaction_db):
+    db = redaction_db.RedactionDatabase()
+    try:
+        db.create_table()
+        db.add_redactions({'Alice': '<ANON_0000000a>'}, namespace='matter-1')
+        tags = db.claim_redactions({'Bob': '<ANON_0000000a>', 'Carol': '<ANON_0000000c>'}, namespace='matter-2')
+        assert tags['Carol'] == '<ANON_0000000c>'
+        assert tags['Bob'] != '<ANON_0000000a>'
+        assert redaction_db._ANON_TAG_RE.fullmatch(tags['Bob'])
+        assert dict(db.get_all_redactions('matter-2')) == tags
+        assert db.get_original('<ANON_0000000a>', ['matter-1']) == 'Alice'
+    finally:
+        db.close()
+
+
+def test_redact_text_survives_minting_a_stored_tag(redaction_db, monkeypatch):
+    redaction_db.redact_text("Alice", {'PERSON': ['Alice']}, namespace='matter-1')
+    stored = redaction_db.RedactionDatabase()
+    try:
+        (_, colliding), = stored.get_all_redactions('matter-1')
+    finally:
+        stored.close()
+    minted = iter([colliding, '<ANON_0000000b>'])
+    monkeypatch.setattr(redaction_db, '_mint_tag', lambda: next(minted))
+    redacted, redaction_map = redaction_db.redact_text("Bob met Alice", {'PERSON': ['Bob']}, namespace='matter-2')
+    assert redaction_map == {'Bob': '<ANON_0000000b>'}
+    assert redacted == "<ANON_0000000b> met Alice"
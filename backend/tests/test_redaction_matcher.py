@@ -0,0 +1,48 @@
+import re
+
+import pytest
+
+from redactor import RedactionMatcher
+
+
+def redact_per_entity(text, entities, tags):
+    """The original one-regex-per-entity loop the matcher replaced."""
+    for entity_type, entity_set in entities.items():
+        for entity in entity_set:
+            if entity_type == 'MANUAL':
+                pattern = re.escape(entity).replace(r'\n', r'\s*\n\s*')
+                flags = re.DOTALL | re.MULTILINE | re.IGNORECASE
+            else:
+                pattern = r'\b' + re.escape(entity) + r'\b'
+                flags = re.IGNORECASE
+            text = re.sub(pattern, tags[entity], text, flags=flags)
+    return text
+
+
+def redact_with_matcher(text, entities, tags):
+    matcher = RedactionMatcher()
+    for entity_type, entity_set in entities.items():
+        for entity in entity_set:
+            matcher.add(entity, tags[entity], manual=entity_type == 'MANUAL')
+    return matcher.sub(text)
+
+
+@pytest.mark.parametrize('text, entities', [
+    ("John Smith met John. Johnson", {'PERSON': ['John Smith'], 'MANUAL': ['John']}),
+    ("john smith met JOHN at Acme Corp.", {'PERSON': ['John Smith'], 'MANUAL': ['john', 'Acme']}),
+    ("Acme Corp and Acme Corporation", {'ORG': ['Acme Corp', 'Acme Corporation'], 'MANUAL': ['Acme']}),
+    ("Call Ann-Marie or Ann today", {'PERSON': ['Ann-Marie'], 'MANUAL': ['Ann']}),
+    ("Jane Doe\n  and Jane\nDoe", {'PERSON': ['Jane Doe'], 'MANUAL': ['Jane\nDoe', 'Jane']}),
+])
+def test_matcher_agrees_with_per_entity_loop(text, entities):
+    tags = {}
+    for entity_set in entities.values():
+        for entity in entity_set:
+            tags.setdefault(entity, f"<T{len(tags)}>")
+    assert redact_with_matcher(text, entities, tags) == redact_per_entity(text, entities, tags)
+
+
+def test_detected_entity_beats_manual_prefix():
+    tags = {'John Smith': '<T0>', 'John': '<T1>'}
+    entities = {'PERSON': ['John Smith'], 'MANUAL': ['John']}
+    assert redact_with_matcher("John Smith met John.", entities, tags) == "<T0> met <T1>."
@@ -1,13 +1,47 @@
 # utils.py
+import logging
+
+logger = logging.getLogger(__name__)
+
 try:
     import spacy
     from spacy.pipeline import EntityRuler
     SPACY_AVAILABLE = True
 except (ImportError, ValueError) as e:
-    print(f"Warning: SpaCy not available: {e}")
+    logger.warning("SpaCy not available: %s", e)
     SPACY_AVAILABLE = False
+import gc
+import hashlib
 import json
 import os
+import re
+import threading
+import time
+from importlib import metadata
+
+from entity_cache import EntityCache, make_cache_key
+from metrics import timed
+
+# Documents are split into chunks of at most this many characters for NER
+NER_CHUNK_SIZE = int(os.environ.get('NER_CHUNK_SIZE', '100000'))
+# Characters of context each NER chunk also reads on either side, so entities
+# straddling a chunk boundary are found whole
+NER_CHUNK_OVERLAP = int(os.environ.get('NER_CHUNK_OVERLAP', '200'))
+# Texts at least this long are processed by NER_PROCESSES worker processes
+NER_MULTIPROCESS_MIN_CHARS = int(os.environ.get('NER_MULTIPROCESS_MIN_CHARS', '2000000'))
+NER_PROCESSES = int(os.environ.get('NER_PROCESSES', '1'))
+# Pipeline components entity extraction never needs
+NER_UNUSED_COMPONENTS = ('parser', 'lemmatizer', 'senter', 'morphologizer')
+# Only needed when custom entity patterns may match on tags
+NER_TAGGING_COMPONENTS = ('tagger', 'attribute_ruler')
+# Models unused for this many seconds are unloaded; 0 keeps them forever
+NLP_MODEL_IDLE_TTL = float(os.environ.get('NLP_MODEL_IDLE_TTL', '1800'))
+# Comma-separated languages to load at import, e.g. "en" or "en,pt". Combine
+# with a preloading server (gunicorn --preload) so forked workers share the
+# model's memory copy-on-write.
+NLP_PRELOAD_MODELS = os.environ.get('NLP_PRELOAD_MODELS', '')
+# Bump when find_entities' filtering changes so cached results are not reused
+ENTITY_EXTRACTION_VERSION = 2
 
 # Function to add custom patterns using EntityRuler
 def add_custom_patterns(nlp, pattern_file='patterns.json'):
@@ -26,46 +60,293 @@ def add_custom_patterns(nlp, pattern_file='patterns.json'):
             ruler.add_patterns(patterns)
             nlp.add_pipe(ruler, before="ner")
         except Exception as e:
-            print(f"Error loading patterns from '{pattern_file}': {e}")
+            logger.error("Error loading patterns from '%s': %s", pattern_file, e)
     else:
-        print(f"Pattern file '{pattern_file}' not found. Skipping custom patterns.")
+        logger.info("Pattern file '%s' not found. Skipping custom patterns.", pattern_file)
 
-# Load larger SpaCy models
-if SPACY_AVAILABLE:
+def _resident_memory():
+    """
+    Returns this process's resident set size in bytes, or None if it
+    can't be determined on this platform.
+    """
     try:
-        nlp_en = spacy.load("en_core_web_md")
-    except OSError:
-        nlp_en = None
-        print("SpaCy English model 'en_core_web_md' not found. Entity detection disabled.")
-
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
     try:
-        nlp_pt = spacy.load("pt_core_news_md")
-    except OSError:
-        nlp_pt = None
-        print("SpaCy Portuguese model 'pt_core_news_md' not found.")
-else:
-    nlp_en = None
-    nlp_pt = None
-
-# Increase the maximum text length appropriately
-if nlp_en:
-    nlp_en.max_length = 1500000
-if nlp_pt:
-    nlp_pt.max_length = 1500000
-
-# Add custom patterns to both models
-if SPACY_AVAILABLE and nlp_en:
-    add_custom_patterns(nlp_en, 'patterns_en.json')
-if SPACY_AVAILABLE and nlp_pt:
-    add_custom_patterns(nlp_pt, 'patterns_pt.json')
-
-def is_valid_person(ent, doc):
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        return None
+
+_file_digests = {}
+
+def _file_digest(path):
+    # Hash of a pattern file's contents, recomputed only when it changes
+    if not path or not os.path.exists(path):
+        return 'none'
+    stat = os.stat(path)
+    cached = _file_digests.get(path)
+    if cached and cached[0] == (stat.st_mtime_ns, stat.st_size):
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    _file_digests[path] = ((stat.st_mtime_ns, stat.st_size), digest)
+    return digest
+
+class _LoadedModel:
+    def __init__(self, nlp, resident_bytes, pinned):
+        self.nlp = nlp
+        self.resident_bytes = resident_bytes
+        self.pinned = pinned
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+class NLPModelRegistry:
+    """
+    Loads SpaCy models on first use and unloads them once idle.
+
+    Models preloaded with `preload()` are pinned: they stay loaded so that
+    worker processes forked afterwards keep sharing their memory.
+    """
+    def __init__(self, idle_ttl=NLP_MODEL_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self._specs = {}
+        self._loaded = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def register(self, language, model_name, pattern_file=None):
+        self._specs[language] = (model_name, pattern_file)
+
+    def version(self, language):
+        """
+        Identifies the model package and pattern file behind a language,
+        without loading the model.
+        """
+        if language not in self._specs:
+            raise ValueError("Unsupported language. Use 'en' for English or 'pt' for Portuguese.")
+        model_name, pattern_file = self._specs[language]
+        try:
+            model_version = metadata.version(model_name)
+        except metadata.PackageNotFoundError:
+            model_version = 'unknown'
+        spacy_version = spacy.__version__ if SPACY_AVAILABLE else 'none'
+        return f"{model_name}=={model_version};spacy=={spacy_version};patterns={_file_digest(pattern_file)}"
+
+    def _load(self, language, pinned):
+        model_name, pattern_file = self._specs[language]
+        before = _resident_memory()
+        try:
+            nlp = spacy.load(model_name)
+        except OSError:
+            logger.warning("SpaCy model '%s' for '%s' not found.", model_name, language)
+            return None
+        if pattern_file:
+            add_custom_patterns(nlp, pattern_file)
+        after = _resident_memory()
+        resident_bytes = after - before if before is not None and after is not None else None
+        logger.info("[NLP] Loaded '%s' for '%s'", model_name, language)
+        return _LoadedModel(nlp, resident_bytes, pinned)
+
+    def get(self, language):
+        """
+        Returns the SpaCy pipeline for a language, loading it if needed,
+        or None if SpaCy or the model is unavailable.
+        """
+        if language not in self._specs:
+            raise ValueError("Unsupported language. Use 'en' for English or 'pt' for Portuguese.")
+        entry = self._loaded.get(language)
+        if entry is None:
+            if not SPACY_AVAILABLE:
+                return None
+            with self._lock:
+                entry = self._loaded.get(language)
+                if entry is None:
+                    entry = self._load(language, pinned=False)
+                    if entry is None:
+                        return None
+                    self._loaded[language] = entry
+                    self._start_reaper()
+        entry.last_used = time.monotonic()
+        return entry.nlp
+
+    def preload(self, languages):
+        """
+        Loads and pins models up front, then freezes the garbage collector's
+        view of them so forked workers don't dirty their shared pages.
+        """
+        if not SPACY_AVAILABLE:
+            return
+        with self._lock:
+            for language in languages:
+                if language not in self._specs:
+                    logger.warning("[NLP] Unknown language '%s' in preload list", language)
+                    continue
+                entry = self._loaded.get(language)
+                if entry is None:
+                    entry = self._load(language, pinned=True)
+                    if entry is not None:
+                        self._loaded[language] = entry
+                elif not entry.pinned:
+                    entry.pinned = True
+        if hasattr(gc, 'freeze'):
+            gc.collect()
+            gc.freeze()
+
+    def evict_idle(self):
+        """
+        Unloads models that haven't been used within idle_ttl seconds.
+        """
+        if self.idle_ttl <= 0:
+            return []
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            for language, entry in list(self._loaded.items()):
+                if not entry.pinned and now - entry.last_used >= self.idle_ttl:
+                    del self._loaded[language]
+                    evicted.append(language)
+        if evicted:
+            gc.collect()
+            logger.info("[NLP] Unloaded idle models: %s", ', '.join(evicted))
+        return evicted
+
+    def _start_reaper(self):
+        if self.idle_ttl <= 0 or (self._reaper is not None and self._reaper.is_alive()):
+            return
+        def reap():
+            while True:
+                time.sleep(max(1.0, self.idle_ttl / 4))
+                self.evict_idle()
+        self._reaper = threading.Thread(target=reap, name='nlp-model-reaper', daemon=True)
+        self._reaper.start()
+
+    def stats(self):
+        """
+        Reports every registered model and, for loaded ones, the resident
+        memory measured while loading it.
+        """
+        now = time.monotonic()
+        report = {}
+        for language, (model_name, _) in self._specs.items():
+            entry = self._loaded.get(language)
+            report[language] = {
+                'model': model_name,
+                'loaded': entry is not None,
+                'pinned': bool(entry and entry.pinned),
+                'resident_bytes': entry.resident_bytes if entry else None,
+                'idle_seconds': round(now - entry.last_used, 1) if entry else None,
+            }
+        return report
+
+nlp_models = NLPModelRegistry()
+nlp_models.register('en', "en_core_web_md", 'patterns_en.json')
+nlp_models.register('pt', "pt_core_news_md", 'patterns_pt.json')
+
+entity_cache = EntityCache()
+
+if NLP_PRELOAD_MODELS:
+    nlp_models.preload([language.strip() for language in NLP_PRELOAD_MODELS.split(',') if language.strip()])
+
+def ner_disabled_components(nlp):
+    """
+    Returns the names of pipeline components that can be skipped when
+    only named entities are needed.
+
+    Args:
+        nlp (spacy.lang.*): The SpaCy language model.
+
+    Returns:
+        list: Component names to pass as `disable` to `nlp.pipe`.
+    """
+    disabled = [name for name in nlp.pipe_names if name in NER_UNUSED_COMPONENTS]
+    if 'entity_ruler' not in nlp.pipe_names:
+        disabled += [name for name in nlp.pipe_names if name in NER_TAGGING_COMPONENTS]
+    # The shared tok2vec layer is only needed if a remaining component listens to it
+    if 'tok2vec' in nlp.pipe_names:
+        listeners = getattr(nlp.get_pipe('tok2vec'), 'listening_components', None)
+        if listeners is not None and not set(listeners) - set(disabled):
+            disabled.append('tok2vec')
+    return disabled
+
+def split_into_chunks(text, chunk_size=None):
+    """
+    Splits text into chunks of at most `chunk_size` characters, breaking on
+    paragraph boundaries where possible and on whitespace otherwise.
+
+    Args:
+        text (str): The input text.
+        chunk_size (int): Maximum chunk length. Defaults to NER_CHUNK_SIZE.
+
+    Returns:
+        list: (offset, chunk) tuples, where offset is the chunk's start in `text`.
+    """
+    chunk_size = chunk_size or NER_CHUNK_SIZE
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            # Prefer the last paragraph break, then the last whitespace
+            cut = text.rfind('\n', start, end)
+            if cut <= start:
+                cut = max(text.rfind(' ', start, end), text.rfind('\t', start, end))
+            if cut > start:
+                end = cut + 1
+        chunks.append((start, text[start:end]))
+        start = end
+    return chunks
+
+_WHITESPACE_RE = re.compile(r'\s')
+
+def overlapping_windows(text, chunks, overlap=None):
+    """
+    Widens chunks from split_into_chunks by up to `overlap` characters on
+    either side, trimmed back to whitespace so no word is cut.
+
+    Args:
+        text (str): The text the chunks were split from.
+        chunks (list): (offset, chunk) tuples.
+        overlap (int): Context characters per side. Defaults to NER_CHUNK_OVERLAP.
+
+    Returns:
+        list: (window_offset, window, chunk_start, chunk_end) tuples. Each
+        match should be kept only by the window whose chunk range holds its
+        start, so matches found in two windows are counted once.
+    """
+    overlap = NER_CHUNK_OVERLAP if overlap is None else overlap
+    windows = []
+    for offset, chunk in chunks:
+        chunk_end = offset + len(chunk)
+        start = max(0, offset - overlap)
+        if start > 0:
+            space = _WHITESPACE_RE.search(text, start, offset)
+            start = space.end() if space else offset
+        end = min(len(text), chunk_end + overlap)
+        if end < len(text):
+            spaces = [match.start() for match in _WHITESPACE_RE.finditer(text, chunk_end, end)]
+            end = spaces[-1] if spaces else chunk_end
+        windows.append((start, text[start:end], offset, chunk_end))
+    return windows
+
+def _previous_word(text, offset):
+    # Word right before offset, used to carry the salutation check across
+    # chunk boundaries. Like spaCy, anything but a single space in between
+    # counts as a separate whitespace token, so no word is returned then.
+    match = re.search(r'(\S+) $', text[max(0, offset - 64):offset])
+    return match.group(1) if match else None
+
+def is_valid_person(ent, doc, previous_word=None):
     """
     Determines whether a PERSON entity is valid based on contextual heuristics.
 
     Args:
         ent (spacy.tokens.Span): The entity span.
         doc (spacy.tokens.Doc): The SpaCy Doc object containing the entity.
+        previous_word (str): Word preceding the doc, when the doc is one
+            chunk of a longer text.
 
     Returns:
         bool: True if the entity is a valid PERSON, False otherwise.
@@ -79,6 +360,8 @@ def is_valid_person(ent, doc):
     token_index = ent.start
     if token_index > 0 and doc[token_index - 1].text.lower() in salutations:
         return True
+    if token_index == 0 and previous_word and previous_word.lower() in salutations:
+        return True
 
     return False
 
@@ -93,12 +376,20 @@ def find_entities(text, language):
     Returns:
         dict: A dictionary containing sets of entities categorized by their labels.
     """
-    if language == 'en':
-        doc = nlp_en(text)
-    elif language == 'pt':
-        doc = nlp_pt(text)
-    else:
-        raise ValueError("Unsupported language. Use 'en' for English or 'pt' for Portuguese.")
+    # Identical text, language and model version give identical results
+    version = f"{ENTITY_EXTRACTION_VERSION};{nlp_models.version(language)}"
+    key = make_cache_key(text, language, version)
+    entities = entity_cache.get(key)
+    if entities is None:
+        entities = _extract_entities(text, language)
+        entity_cache.put(key, entities)
+    return entities
+
+@timed('ner')
+def _extract_entities(text, language):
+    nlp = nlp_models.get(language)
+    if nlp is None:
+        raise RuntimeError(f"SpaCy model for '{language}' is not available. Entity detection disabled.")
 
     entities = {
         'PERSON': set(),
@@ -106,11 +397,27 @@ def find_entities(text, language):
         'ORG': set()
     }
 
-    for ent in doc.ents:
-        if ent.label_ in entities:
-            if ent.label_ == 'PERSON' and not is_valid_person(ent, doc):
+    # Run NER over paragraph-aligned chunks in a stream instead of one huge
+    # Doc; each chunk is read with some context on either side
+    windows = overlapping_windows(text, split_into_chunks(text))
+    n_process = NER_PROCESSES if len(text) >= NER_MULTIPROCESS_MIN_CHARS else 1
+    docs = nlp.pipe(
+        ((window, (offset, chunk_start, chunk_end)) for offset, window, chunk_start, chunk_end in windows),
+        as_tuples=True,
+        disable=ner_disabled_components(nlp),
+        n_process=n_process,
+    )
+
+    for doc, (offset, chunk_start, chunk_end) in docs:
+        previous_word = _previous_word(text, offset) if offset else None
+        for ent in doc.ents:
+            # Entities starting in the context belong to the neighbouring chunk
+            if not chunk_start <= offset + ent.start_char < chunk_end:
                 continue
-            if len(ent.text.strip()) > 2:
-                entities[ent.label_].add(ent.text.strip())
+            if ent.label_ in entities:
+                if ent.label_ == 'PERSON' and not is_valid_person(ent, doc, previous_word):
+                    continue
+                if len(ent.text.strip()) > 2:
+                    entities[ent.label_].add(ent.text.strip())
 
     return entities
\ No newline at end of file
@@ -149,6 +149,52 @@ export default function RedactorApp() {
     setApiKeysConfigured(status);
   };
 
+  // Server-side redaction session for the current text: once it exists, a
+  // selection sends only the new entity and gets back the edits to apply
+  const redactionSessionRef = useRef(null);
+
+  const redactSelectionInSession = async (text, customEntities, retry = true) => {
+    let session = redactionSessionRef.current;
+    if (!session || session.text !== text) {
+      const created = await axios.post(`${API_BASE}/redact-sessions`, { text });
+      session = { id: created.data.session_id, version: created.data.version, text };
+    }
+    let res;
+    try {
+      res = await axios.post(`${API_BASE}/redact`, {
+        session_id: session.id,
+        version: session.version,
+        entities: {},
+        custom_entities: customEntities
+      });
+    } catch (err) {
+      // Expired or out-of-sync session: start over from the text we have
+      const status = err.response?.status;
+      if (retry && (status === 404 || status === 409)) {
+        redactionSessionRef.current = null;
+        return redactSelectionInSession(text, customEntities, false);
+      }
+      throw err;
+    }
+    let newText;
+    if (/[\uD800-\uDFFF]/.test(text)) {
+      // Edit offsets count code points, which differ from JS string indices here
+      const full = await axios.get(`${API_BASE}/redact-sessions/${session.id}`);
+      newText = full.data.text;
+    } else {
+      const pieces = [];
+      let position = 0;
+      for (const [start, end, tag] of res.data.edits) {
+        pieces.push(text.slice(position, start), tag);
+        position = end;
+      }
+      pieces.push(text.slice(position));
+      newText = pieces.join('');
+    }
+    redactionSessionRef.current = { id: session.id, version: res.data.version, text: newText };
+    return newText;
+  };
+
   // Robustly get highlighted text from the DOM and immediately redact
   const handleSelectionAndRedact = async () => {
     const selectionObj = window.getSelection();
@@ -160,13 +206,10 @@ export default function RedactorApp() {
       setError('');
       setFollowUpResponse(''); // Clear previous follow-up response on redact
       try {
-        const res = await axios.post(`${API_BASE}/redact`, {
-          text: extractedText, // Send current text
-          entities: {},
-          custom_entities: [selectedText] // Send the new selection to redact
-        });
-        // Update the text area with the newly redacted text from the backend
-        setExtractedText(res.data.redacted_text);
+        // Send the new selection to redact; the session already has the text
+        const redacted = await redactSelectionInSession(extractedText, [selectedText]);
+        // Update the text area with the newly redacted text
+        setExtractedText(redacted);
       } catch (err) {
         setError(err.response?.data?.error || 'Redaction on selection failed');
       } finally {